@@ -16,17 +16,31 @@
 """Perform analysis on the pcap data to look for simlarities."""
 
 import argparse
+import array
+import collections
+import heapq
+import itertools
+import mmap
+import multiprocessing
+import operator
 import os
 import pdb
+import Queue
+import re
 import socket
 import struct
 import sys
+import threading
 import traceback
+import zlib
 
 import dpkt
 import pcap
 import scapy
 
+import hyperloglog
+import statsfile
+
 AP_FLAGS = argparse.ArgumentParser(description='File Analysis')
 AP_FLAGS.add_argument('--output_pcap', help='Output unknown pcap',
                       default='')
@@ -36,25 +50,87 @@ AP_FLAGS.add_argument('--detail', help='Export detail',
                       default=False, action='store_true')
 AP_FLAGS.add_argument('--overwrite', help='Overwrite stats files',
                       default=False, action='store_true')
+AP_FLAGS.add_argument('--rules', help='Traffic class rules file, reloaded '
+                      'when it changes (default: built-in rules)', default='')
+AP_FLAGS.add_argument('--jobs', help='Worker processes to analyze with',
+                      type=int, default=1)
+AP_FLAGS.add_argument('--chunk_mb', help='With --jobs, split pcaps larger '
+                      'than this across workers', type=int, default=128)
+AP_FLAGS.add_argument('--sketch_size', help='Keep at most this many values '
+                      'per stats table (sport, src_ip, ...), approximating '
+                      'the top ones; 0 keeps exact counts',
+                      type=int, default=0)
+AP_FLAGS.add_argument('--batch_size', help='Packets to decode per batch',
+                      type=int, default=4096)
+AP_FLAGS.add_argument('--stats_format', help='tsv, or binary for the '
+                      'compact format in statsfile.py', default='tsv',
+                      choices=('tsv', 'binary'))
+AP_FLAGS.add_argument('--distinct_counts', help='Also count the distinct '
+                      'src_ip, sport and dst_ip of each class, and write the '
+                      'sketches to the .stats file for graph_analysis '
+                      '--distinct_dir', default=False, action='store_true')
+AP_FLAGS.add_argument('--drop_stats_dir', help='Where onesniff writes the '
+                      'packets it dropped from each capture',
+                      default='/sdb2/stats.pcap')
 AP_FLAGS.add_argument('input_files', help='Input files to parse', nargs='+')
 
 FLAGS = None
 
+# pcap global header magic -> (byte order, timestamp fraction divisor)
+PCAP_MAGIC = {
+    '\xd4\xc3\xb2\xa1': ('<', 1e6),
+    '\xa1\xb2\xc3\xd4': ('>', 1e6),
+    '\x4d\x3c\xb2\xa1': ('<', 1e9),  # nanosecond resolution
+    '\xa1\xb2\x3c\x4d': ('>', 1e9),
+}
+PCAP_HEADER_LEN = 24
+PCAP_RECORD_LEN = 16
+ETH_HEADER_LEN = 14
+# no capture has a longer record than this; anything bigger is corruption
+MAX_CAPLEN = 1 << 18
+# compressed bytes read at a time from a .pcap.gz, and how many inflated
+# blocks may wait for the decoder
+GZIP_READ_LEN = 1 << 20
+GZIP_QUEUE_BLOCKS = 8
+# ver/ihl, frag offset (high byte), proto, src, dst, starting at the IP header
+IP_HEADER = struct.Struct('!B5xB2xB2xII')
+PORTS = struct.Struct('!HH')
+
 
 class Stats(object):
-  def __init__(self, name):
+  def __init__(self, name, formatter=str, distinct=False):
     self.name = name
+    # values are kept in their compact form and only formatted for output
+    self.formatter = formatter
     self.stats = {}
     self.totals = [0, 0]
+    # distinct values seen, counted apart from self.stats so it stays right
+    # when SketchStats drops values
+    self.distinct = None
+    if distinct:
+      self.distinct = hyperloglog.HyperLogLog()
 
   def add(self, val, pktlen):
     if val not in self.stats:
       self.stats[val] = [0, 0]
+      if self.distinct:
+        self.distinct.Add(val)
     self.stats[val][0] += 1  # packets
     self.stats[val][1] += pktlen  # packet length
     self.totals[0] += 1
     self.totals[1] += pktlen
 
+  def Merge(self, other):
+    for val, (pkts, pktlen) in other.stats.iteritems():
+      if val not in self.stats:
+        self.stats[val] = [0, 0]
+      self.stats[val][0] += pkts
+      self.stats[val][1] += pktlen
+    self.totals[0] += other.totals[0]
+    self.totals[1] += other.totals[1]
+    if self.distinct:
+      self.distinct.Merge(other.distinct)
+
   def PrintTotals(self):
     print '%5d %6dkB' % (self.totals[0], self.totals[1]/1000)
 
@@ -66,168 +142,1008 @@ class Stats(object):
     for i in xrange(min(10, len(val_list))):
       print '%5d %6dkB %s' % (
           self.stats[val_list[i]][0], self.stats[val_list[i]][1]/1000,
-          val_list[i])
+          self.formatter(val_list[i]))
+
+
+class SketchStats(Stats):
+  """Stats holding at most capacity values, using Space-Saving.
+
+  When a new value arrives and the table is full, the value with the fewest
+  packets is dropped and the new one takes over its counts. A value's counts
+  can overstate it by at most errors[val], which is no more than
+  totals[0]/capacity packets; a value seen more often than that is always
+  in the table. totals stay exact.
+  """
+
+  def __init__(self, name, formatter=str, distinct=False, capacity=1000):
+    Stats.__init__(self, name, formatter, distinct)
+    self.capacity = capacity
+    self.errors = {}
+    # (packets, val), at most one per val; packets may be out of date
+    self.heap = []
+
+  def add(self, val, pktlen):
+    entry = self.stats.get(val)
+    if entry is None:
+      if len(self.stats) >= self.capacity:
+        entry = self.Evict()
+        self.errors[val] = entry[0]
+      else:
+        entry = [0, 0]
+      self.stats[val] = entry
+      if self.distinct:
+        # a value coming back after being dropped is already counted
+        self.distinct.Add(val)
+      heapq.heappush(self.heap, (entry[0]+1, val))
+    entry[0] += 1  # packets
+    entry[1] += pktlen  # packet length
+    self.totals[0] += 1
+    self.totals[1] += pktlen
+
+  def Evict(self):
+    """Remove the value with the fewest packets, returning its counts."""
+    while True:
+      pkts, val = self.heap[0]
+      entry = self.stats[val]
+      if entry[0] == pkts:
+        heapq.heappop(self.heap)
+        del self.stats[val]
+        self.errors.pop(val, None)
+        return entry
+      heapq.heapreplace(self.heap, (entry[0], val))
+
+  def Merge(self, other):
+    # A value missing from a full table may have had up to that table's
+    # smallest count, so charge it that as both count and error.
+    def MinCounts(sketch):
+      if len(sketch.stats) < sketch.capacity or not sketch.stats:
+        return 0, 0
+      return min(sketch.stats.itervalues())
+    self_min, other_min = MinCounts(self), MinCounts(other)
+    merged = {}
+    errors = {}
+    for val in set(self.stats) | set(other.stats):
+      pkts_a, bytes_a = self.stats.get(val, self_min)
+      pkts_b, bytes_b = other.stats.get(val, other_min)
+      merged[val] = [pkts_a + pkts_b, bytes_a + bytes_b]
+      errors[val] = (self.errors.get(val, 0) + other.errors.get(val, 0) +
+                     (val not in self.stats and self_min[0] or 0) +
+                     (val not in other.stats and other_min[0] or 0))
+    keep = heapq.nlargest(self.capacity, merged, key=lambda x: merged[x][0])
+    self.stats = dict((val, merged[val]) for val in keep)
+    self.errors = dict((val, errors[val]) for val in keep if errors[val])
+    self.heap = [(entry[0], val) for val, entry in self.stats.iteritems()]
+    heapq.heapify(self.heap)
+    self.totals[0] += other.totals[0]
+    self.totals[1] += other.totals[1]
+    if self.distinct:
+      self.distinct.Merge(other.distinct)
+
+  def PrintStats(self):
+    val_list = heapq.nlargest(10, self.stats, key=lambda x: self.stats[x][0])
+    print '%s %s (top of %d kept) %s' % (
+        '=' * 10, self.name, len(self.stats), '=' * 10)
+    for val in val_list:
+      print '%5d %6dkB %s (+/-%d)' % (
+          self.stats[val][0], self.stats[val][1]/1000, self.formatter(val),
+          self.errors.get(val, 0))
 
 
 class StatsGroup(object):
-  def __init__(self, *args):
+  def __init__(self, *args, **kwargs):
+    # sketch_size: use SketchStats of that capacity instead of Stats
+    sketch_size = kwargs.get('sketch_size', 0)
+    # distinct: the elements that also count their distinct values
+    distinct_stats = kwargs.get('distinct', ())
     self.groups = args
     for element in args:
-      self.__dict__[element] = Stats(element)
-
-
-class Classification(object):
-  def __init__(self, pkt):
-    self.pkt = pkt
-    self.name = self.Classify(pkt)
-
-  def PktType(self, pkt, protocol, general_class,
-              specific_class=''):
-    return '%s:%s:%s:%s|%d' % (
-        protocol, general_class, specific_class, pkt['dst_ip'],
-        pkt.get('dport', 0))
-
-  def Classify(self, pkt):
-    # Syntax:
-    # protocol:general class name:specific class name:dstip|port
-    # ex:
-    #  UDP:flood:0xffff:1.1.1.1|80
-    if pkt['proto'] == 17 and len(pkt.raw) > 70:
-      if (pkt.raw[52:56] == pkt.raw[56:60] and
-          pkt.raw[52:54] == pkt.raw[54:56]):
-        return self.PktType(
-            pkt, 'UDP', 'flood', specific_class='0x%02x%02x' %
-            (ord(pkt.raw[52]), ord(pkt.raw[53])))
-      if (struct.unpack('H', pkt.raw[50:52])[0]+0x101 ==
-          struct.unpack('H', pkt.raw[66:68])[0] and
-          struct.unpack('H', pkt.raw[52:54])[0]+0x101 ==
-          struct.unpack('H', pkt.raw[68:70])[0]):
-        return self.PktType(
-            pkt, 'UDP', 'flood', specific_class='0x101-offset')
-    if (pkt['proto'] == 17 and pkt.get('dport', None) == 37 and
-        pkt.pktlen == 60):
-      # <Ether  dst=00:15:17:ed:a2:e0 src=00:1f:12:8e:00:00 type=0x800 |
-      #  <IP  version=4L ihl=5L tos=0x0 len=28 id=18019 flags=DF frag=0L
-      #   ttl=44 proto=udp chksum=0xd37c src=86.130.220.109 dst=1.1.1.1
-      #   options=[] |<UDP  sport=16046 dport=time len=8 chksum=0x8c19 |
-      #  <Padding  load='\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00
-      #   \x00\x00\x00\x00\x00\x00\x00' |>>>>
-      # randomly checking some of the source IPs, it's all
-      # host109-156-40-233.range109-156.btcentralplus.com. domains.
-      if pkt['src_ip'][:3] in ('86.', '81.', '109', '217'):
-        return self.PktType(pkt, 'UDP', 'flood',
-                            specific_class='btcentral-time')
-    if pkt['proto'] == 17 and pkt.get('dport') == 53:
-      if pkt['sport'] == 53:
-        return self.PktType(pkt, 'UDP', 'DNS', specific_class='DNSAnswer')
-      return self.PktType(pkt, 'UDP', 'DNS', specific_class='DNSReq')
-    if pkt['proto'] == 17 and pkt.get('dport', 0) == 5060:
-      if 'REGISTER' in pkt.raw:
-        return self.PktType(pkt, 'UDP', 'SIP', specific_class='REGISTER')
-      if 'OPTIONS' in pkt.raw:
-        return self.PktType(pkt, 'UDP', 'SIP', specific_class='OPTIONS')
-      return self.PktType(pkt, 'UDP', 'SIP')
-    if pkt['proto'] == 17 and pkt.get('dport') == 2727:
-      if 'RSIP' in pkt.raw:
-        return self.PktType(pkt, 'UDP', 'MGCP', specific_class='RestartIP')
-      return self.PktType(pkt, 'UDP', 'MGCP')
-    if pkt['proto'] == 6:
-      if pkt.get('dport', 0) == 8888 and pkt['dst_ip'] == '1.2.3.4':
-        return self.PktType(pkt, 'TCP', 'HotelNet')
-    # Below? It's unclassfied, essentially...
-    # elements matching a single ip:port are grouped together, so only things
-    # that are more unique than that (eg, packet contents, sources, etc)
-    # need to be called out above.
-    if pkt['proto'] == 6:
-      if pkt.get('flags', 0)&0x2 > 0:  # SYN
-        return self.PktType(pkt, 'TCP', 'SYN')
-      if pkt.get('flags', 0) & 0x5 > 0:  # FIN or RST
-        return self.PktType(pkt, 'TCP', 'Close')
-      return self.PktType(pkt, 'TCP', 'ACK')
-    if pkt['proto'] == 17:
-      return self.PktType(pkt, 'UDP', '')
-    if pkt['proto'] == 6:  # In case anything slipped through above
-      return self.PktType(pkt, 'TCP', '')
-    if pkt['proto'] == 1:
-      pkt.fields['dport'] = pkt.get('code', 0)
-      return self.PktType(pkt, 'ICMP', 'type-%d' % pkt.get('type', 0))
-    if pkt['proto'] == 47:
-      return self.PktType(pkt, 'GRE', '')
-    return self.PktType(pkt, 'MiscProto', 'Proto-%d' % pkt['proto'])
-
-
-class Packet(object):
-  def __init__(self, pkt, pktlen):
-    self.fields = self.Decode(pkt)
-    self.pktlen = pktlen
-    self.raw = pkt
-
-  def get(self, s, default=None):
-    if s in self.fields:
-      return self.fields[s]
-    return default
-
-  def __getitem__(self, s):
-    return self.fields[s]
-
-  def Decode(self, s):
-    d = {}
-    ofs = 14
-    d['header_len'] = ord(s[ofs+0]) & 0x0f
-    d['frag_offset'] = socket.ntohs(
-        struct.unpack('H', s[ofs+6:ofs+8])[0] & 0x1f)
-    d['proto'] = ord(s[ofs+9])
-    d['src_ip'] = pcap.ntoa(struct.unpack('i', s[ofs+12:ofs+16])[0])
-    d['dst_ip'] = pcap.ntoa(struct.unpack('i', s[ofs+16:ofs+20])[0])
-    if d['frag_offset'] == 0:
-      offset = d['header_len']<<2
-      if d['proto'] in (6, 17) and len(s) >= offset+4:
-        d['sport'] = socket.ntohs(
-            struct.unpack('H', s[ofs+offset:ofs+offset+2])[0])
-        d['dport'] = socket.ntohs(
-            struct.unpack('H', s[ofs+offset+2:ofs+offset+4])[0])
-        if len(s) >= offset+14 and d['proto'] == 6:
-          d['flags'] = ord(s[ofs+offset+13])
-      elif d['proto'] == 1 and len(s) >= offset+4:
-        d['type'] = ord(s[ofs+offset])
-        d['code'] = ord(s[ofs+offset+1])
-    return d
+      formatter = STATS_FORMATTERS.get(element, str)
+      distinct = element in distinct_stats
+      if sketch_size:
+        self.__dict__[element] = SketchStats(
+            element, formatter, distinct, sketch_size)
+      else:
+        self.__dict__[element] = Stats(element, formatter, distinct)
 
+  def Merge(self, other):
+    for element in self.groups:
+      self.__dict__[element].Merge(other.__dict__[element])
 
-class PacketProcessing(object):
+
+# Rules are tried in order; the first one to match names the packet.
+# Each line is a class name followed by the predicates a packet must pass:
+#   proto=N dport=N sport=N pktlen=N   exact values
+#   min_caplen=N                       at least N bytes captured
+#   flags=MASK                         any of these TCP flags set
+#   src=NET[/LEN],... dst=NET[/LEN],...  address prefixes
+#   equal=A:B:LEN                      same bytes at offsets A and B
+#   word_delta=A:B:DELTA               16-bit word at B is the word at A+DELTA
+#   contains=BYTES[@START:END]         appears in the packet, optionally
+#                                      only within [START, END) (\xNN escapes)
+# Offsets count from the start of the captured frame. The class name is
+# protocol:general class name:specific class name and may use {proto},
+# {icmp_type} or {hex:OFFSET:LEN} from the packet. The dst ip and port are
+# appended to make the stats key, ex:
+#  UDP:flood:0xffff:1.1.1.1|80
+DEFAULT_RULES = r"""
+UDP:flood:{hex:52:2}       proto=17 min_caplen=71 equal=52:56:4 equal=52:54:2
+UDP:flood:0x101-offset     proto=17 min_caplen=71 word_delta=50:66:0x101 word_delta=52:68:0x101
+# <Ether  dst=00:15:17:ed:a2:e0 src=00:1f:12:8e:00:00 type=0x800 |
+#  <IP  version=4L ihl=5L tos=0x0 len=28 id=18019 flags=DF frag=0L
+#   ttl=44 proto=udp chksum=0xd37c src=86.130.220.109 dst=1.1.1.1
+#   options=[] |<UDP  sport=16046 dport=time len=8 chksum=0x8c19 |
+#  <Padding  load='\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00
+#   \x00\x00\x00\x00\x00\x00\x00' |>>>>
+# randomly checking some of the source IPs, it's all
+# host109-156-40-233.range109-156.btcentralplus.com. domains.
+UDP:flood:btcentral-time   proto=17 dport=37 pktlen=60 src=86.0.0.0/8,81.0.0.0/8,109.0.0.0/8,217.0.0.0/8
+UDP:DNS:DNSAnswer          proto=17 dport=53 sport=53
+UDP:DNS:DNSReq             proto=17 dport=53
+UDP:SIP:REGISTER           proto=17 dport=5060 contains=REGISTER
+UDP:SIP:OPTIONS            proto=17 dport=5060 contains=OPTIONS
+UDP:SIP:                   proto=17 dport=5060
+UDP:MGCP:RestartIP         proto=17 dport=2727 contains=RSIP
+UDP:MGCP:                  proto=17 dport=2727
+TCP:HotelNet:              proto=6 dport=8888 dst=1.2.3.4
+# Below? It's unclassfied, essentially...
+# elements matching a single ip:port are grouped together, so only things
+# that are more unique than that (eg, packet contents, sources, etc)
+# need to be called out above.
+TCP:SYN:                   proto=6 flags=0x2
+# FIN or RST
+TCP:Close:                 proto=6 flags=0x5
+TCP:ACK:                   proto=6
+UDP::                      proto=17
+ICMP:type-{icmp_type}:     proto=1
+GRE::                      proto=47
+MiscProto:Proto-{proto}:
+"""
+
+
+CONTAINS_WINDOW_RE = re.compile(r'(.*)@(\d*):(\d*)$')
+
+
+class RuleError(Exception):
+  pass
+
+
+class PrefixTrie(object):
+  """IPv4 prefix lookup, one octet per level.
+
+  Prefixes that don't end on an octet boundary are expanded to cover all
+  the octet values below them, so a lookup is at most four dict hits.
+  """
 
   def __init__(self):
+    # octet -> [value, prefix len of value, child node]
+    self.root = {}
+
+  def Add(self, addr, plen, value=True):
+    node = self.root
+    shift = 24
+    while plen - (24-shift) > 8:
+      octet = (addr >> shift) & 0xff
+      entry = node.setdefault(octet, [None, -1, {}])
+      node = entry[2]
+      shift -= 8
+    span = 1 << (8 - (plen - (24-shift)))
+    first = (addr >> shift) & 0xff & ~(span-1)
+    for octet in xrange(first, first+span):
+      entry = node.setdefault(octet, [None, -1, {}])
+      if plen >= entry[1]:
+        # longest prefix wins
+        entry[0], entry[1] = value, plen
+
+  def Lookup(self, addr):
+    value = None
+    node = self.root
+    for shift in (24, 16, 8, 0):
+      entry = node.get((addr >> shift) & 0xff)
+      if entry is None:
+        break
+      if entry[0] is not None:
+        value = entry[0]
+      node = entry[2]
+    return value
+
+
+class ColumnPredicate(object):
+  """Compare a decoded column against a constant, e.g. sport == 53."""
+
+  def __init__(self, column, op, value):
+    self.column = column
+    self.op = op
+    self.value = value
+
+  def Select(self, batch, indices, unused_scan):
+    column = getattr(batch, self.column)
+    return list(itertools.compress(indices, itertools.imap(
+        self.op, itertools.imap(column.__getitem__, indices),
+        itertools.repeat(self.value))))
+
+
+class AddressPredicate(object):
+  """Match an address column against a set of prefixes."""
+
+  def __init__(self, column, prefixes):
+    self.column = column
+    self.trie = PrefixTrie()
+    for addr, plen in prefixes:
+      self.trie.Add(addr, plen)
+
+  def Select(self, batch, indices, unused_scan):
+    column = getattr(batch, self.column)
+    return list(itertools.compress(indices, itertools.imap(
+        self.trie.Lookup, itertools.imap(column.__getitem__, indices))))
+
+
+class PayloadPredicate(object):
+  """Run a test against the captured bytes of each packet."""
+
+  def __init__(self, test):
+    self.test = test
+
+  def Select(self, batch, indices, unused_scan):
+    buf, offset, caplen, test = batch.buf, batch.offset, batch.caplen, self.test
+    return [i for i in indices if test(buf, offset[i], caplen[i])]
+
+
+class SignaturePredicate(PayloadPredicate):
+  """The packet holds a signature, as found by the group's PayloadMatcher."""
+
+  def __init__(self, signature):
+    PayloadPredicate.__init__(self, None)
+    # (pattern, window start, window end or None)
+    self.signature = signature
+
+  def Select(self, batch, indices, scan):
+    signature = self.signature
+    return [i for i in indices if signature in scan.Signatures(i)]
+
+
+class PayloadMatcher(object):
+  """Find all of a set of signatures in a packet with a single scan.
+
+  The patterns are compiled into one regex alternation, longest first, and
+  tried as a lookahead so overlapping hits aren't skipped. Where several
+  patterns start at the same offset the longest one is reported; the
+  patterns that are a prefix of it matched there too.
+  """
+
+  def __init__(self, signatures):
+    patterns = sorted(set(pattern for pattern, _, _ in signatures),
+                      key=len, reverse=True)
+    self.regex = re.compile(
+        '(?=(%s))' % '|'.join(re.escape(pattern) for pattern in patterns))
+    # matched pattern -> signatures that a hit on it satisfies, if in window
+    self.hits = {}
+    for pattern in patterns:
+      self.hits[pattern] = [
+          (signature, len(signature[0])) for signature in signatures
+          if pattern.startswith(signature[0])]
+
+  def Scan(self, buf, start, caplen):
+    """Return the set of signatures in buf[start:start+caplen]."""
+    found = set()
+    for match in self.regex.finditer(buf, start, start+caplen):
+      pos = match.start() - start
+      for signature, length in self.hits[match.group(1)]:
+        _, window_start, window_end = signature
+        if pos >= window_start and (
+            window_end is None or pos + length <= window_end):
+          found.add(signature)
+    return found
+
+
+class SignatureScan(object):
+  """Per-packet PayloadMatcher results for one Classify group."""
+
+  def __init__(self, matcher, batch):
+    self.matcher = matcher
+    self.batch = batch
+    self.found = {}
+
+  def Signatures(self, i):
+    if i not in self.found:
+      batch = self.batch
+      self.found[i] = self.matcher.Scan(
+          batch.buf, batch.offset[i], batch.caplen[i])
+    return self.found[i]
+
+
+def PayloadEqual(ofs_a, ofs_b, length):
+  """buf[ofs_a:ofs_a+length] == buf[ofs_b:ofs_b+length]."""
+  need = max(ofs_a, ofs_b) + length
+  def Test(buf, start, caplen):
+    return (caplen >= need and buf[start+ofs_a:start+ofs_a+length] ==
+            buf[start+ofs_b:start+ofs_b+length])
+  return PayloadPredicate(Test)
+
+
+def PayloadWordDelta(ofs_a, ofs_b, delta):
+  """The 16-bit word at ofs_b is the word at ofs_a plus delta."""
+  need = max(ofs_a, ofs_b) + 2
+  word = struct.Struct('H')
+  def Test(buf, start, caplen):
+    return (caplen >= need and word.unpack_from(buf, start+ofs_a)[0]+delta ==
+            word.unpack_from(buf, start+ofs_b)[0])
+  return PayloadPredicate(Test)
+
+
+def ParseAddress(addr):
+  return struct.unpack('!I', socket.inet_aton(addr))[0]
+
+
+def ParsePrefix(prefix):
+  if '/' in prefix:
+    addr, plen = prefix.split('/')
+    plen = int(plen)
+  else:
+    addr, plen = prefix, 32
+  if not 0 < plen <= 32:
+    raise ValueError('bad prefix length in %s' % prefix)
+  return ParseAddress(addr), plen
+
+
+def IpString(addr):
+  return socket.inet_ntoa(struct.pack('!I', addr))
+
+
+def ProtoPortString(proto_dport):
+  return '(%d, %d)' % (proto_dport >> 16, proto_dport & 0xffff)
+
+
+def DistinctStats():
+  """The stats to count distinct values of; none without --distinct_counts."""
+  return DISTINCT_STATS if FLAGS.distinct_counts else ()
+
+
+# Stats that also count their distinct values with --distinct_counts, written
+# to the .stats file as distinct_<name>=<estimate>:<hyperloglog registers>
+DISTINCT_STATS = ('src_ip', 'sport', 'dst_ip')
+
+# Stats keys that are stored packed, and how to print them
+STATS_FORMATTERS = {
+    'dst_ip': IpString,
+    'src_ip': IpString,
+    'proto_dport': ProtoPortString,  # proto << 16 | dport
+}
+
+
+class Rule(object):
+  """A traffic class: the predicates a packet must pass and the name to use.
+
+  proto and dport aren't in predicates; the Classifier only hands a rule
+  packets that already match them.
+  """
+
+  FIELD_RE = re.compile(r'\{([^}]*)\}')
+
+  def __init__(self, name, predicates, proto=None, dport=None):
+    self.name = name
+    self.predicates = predicates
+    self.proto = proto
+    self.dport = dport
+    self.fields = []
+    for field in self.FIELD_RE.findall(name):
+      field_split = field.split(':')
+      if field_split[0] == 'hex' and len(field_split) == 3:
+        self.fields.append(('hex', int(field_split[1], 0),
+                            int(field_split[2], 0)))
+      elif field_split[0] in ('proto', 'icmp_type') and len(field_split) == 1:
+        self.fields.append((field_split[0],))
+      else:
+        raise ValueError('unknown field {%s}' % field)
+    self.name_format = self.FIELD_RE.sub('%s', name.replace('%', '%%'))
+
+  def Select(self, batch, indices, scan):
+    for predicate in self.predicates:
+      if not indices:
+        break
+      indices = predicate.Select(batch, indices, scan)
+    return indices
+
+  def Signatures(self):
+    return [p.signature for p in self.predicates
+            if isinstance(p, SignaturePredicate)]
+
+  def FieldValues(self, batch, i):
+    values = []
+    for field in self.fields:
+      if field[0] == 'hex':
+        start = batch.offset[i] + field[1]
+        values.append('0x' + batch.buf[start:start+field[2]].encode('hex'))
+      else:
+        values.append(getattr(batch, field[0])[i])
+    return tuple(values)
+
+
+def ParseRules(text, source):
+  """Parse rules in the DEFAULT_RULES syntax into a list of Rule."""
+  rules = []
+  for line_num, line in enumerate(text.splitlines(), 1):
+    line_split = line.split('#', 1)[0].split()
+    if not line_split:
+      continue
+    name = line_split[0]
+    proto = dport = None
+    predicates = []
+    try:
+      if Rule.FIELD_RE.sub('', name).count(':') != 2:
+        raise ValueError('class name must be protocol:general:specific')
+      for predicate in line_split[1:]:
+        key, _, value = predicate.partition('=')
+        if key == 'proto':
+          proto = int(value, 0)
+        elif key == 'dport':
+          dport = int(value, 0)
+        elif key in ('sport', 'pktlen'):
+          predicates.append(
+              ColumnPredicate(key, operator.eq, int(value, 0)))
+        elif key == 'min_caplen':
+          predicates.append(
+              ColumnPredicate('caplen', operator.ge, int(value, 0)))
+        elif key == 'flags':
+          predicates.append(
+              ColumnPredicate('flags', operator.and_, int(value, 0)))
+        elif key in ('src', 'dst'):
+          predicates.append(AddressPredicate(
+              key + '_ip', [ParsePrefix(p) for p in value.split(',')]))
+        elif key == 'equal':
+          ofs_a, ofs_b, length = [int(v, 0) for v in value.split(':')]
+          predicates.append(PayloadEqual(ofs_a, ofs_b, length))
+        elif key == 'word_delta':
+          ofs_a, ofs_b, delta = [int(v, 0) for v in value.split(':')]
+          predicates.append(PayloadWordDelta(ofs_a, ofs_b, delta))
+        elif key == 'contains':
+          window_match = CONTAINS_WINDOW_RE.match(value)
+          window_start, window_end = 0, None
+          if window_match:
+            value, window_start, window_end = window_match.groups()
+            window_start = int(window_start or 0)
+            window_end = int(window_end) if window_end else None
+          pattern = value.decode('string_escape')
+          if not pattern:
+            raise ValueError('empty contains= pattern')
+          if (window_end is not None and
+              window_end - window_start < len(pattern)):
+            raise ValueError('contains= window too small for %r' % pattern)
+          predicates.append(
+              SignaturePredicate((pattern, window_start, window_end)))
+        else:
+          raise ValueError('unknown predicate %s' % predicate)
+      # cheap column tests first, payload tests on whatever is left
+      predicates.sort(key=lambda x: isinstance(x, PayloadPredicate))
+      rules.append(Rule(name, predicates, proto=proto, dport=dport))
+    except (ValueError, socket.error), e:
+      raise RuleError('%s:%d: %s' % (source, line_num, e))
+  return rules
+
+
+class Classifier(object):
+  """Classify a PacketBatch at a time.
+
+  Packets are split up by (proto, dport) and each group is run through
+  only the rules that can match it, in rule order. A rule narrows its
+  group column by column, so payload tests only run on the few packets
+  that get that far. All the contains= signatures of a group's rules are
+  looked for in a single PayloadMatcher scan of the packet.
+  """
+
+  def __init__(self, rules_text, source):
+    rules = ParseRules(rules_text, source)
+    self.rules_text = rules_text
+    self.rules = rules
+    self.names = {}
+    # values that some rule cares about map to themselves, others to None
+    self.protos = dict((r.proto, r.proto) for r in rules
+                       if r.proto is not None)
+    self.dports = dict((r.dport, r.dport) for r in rules
+                       if r.dport is not None)
+    self.dispatch = {}
+    self.matchers = {}
+    for proto in self.protos.keys() + [None]:
+      for dport in self.dports.keys() + [None]:
+        rule_ids = [
+            rule_id for rule_id, rule in enumerate(rules)
+            if rule.proto in (None, proto) and rule.dport in (None, dport)]
+        self.dispatch[(proto, dport)] = rule_ids
+        signatures = set()
+        for rule_id in rule_ids:
+          signatures.update(rules[rule_id].Signatures())
+        if signatures:
+          self.matchers[(proto, dport)] = PayloadMatcher(list(signatures))
+
+  def Classify(self, batch):
+    """Return the index of the matching rule for each packet, -1 if none."""
+    rule_ids = array.array('i', [-1]) * len(batch)
+    groups = collections.defaultdict(list)
+    keys = itertools.izip(itertools.imap(self.protos.get, batch.proto),
+                          itertools.imap(self.dports.get, batch.dport))
+    for i, key, valid in itertools.izip(itertools.count(), keys, batch.valid):
+      if valid:
+        groups[key].append(i)
+    for key, remaining in groups.iteritems():
+      scan = None
+      if key in self.matchers:
+        scan = SignatureScan(self.matchers[key], batch)
+      for rule_id in self.dispatch[key]:
+        matched = self.rules[rule_id].Select(batch, remaining, scan)
+        if not matched:
+          continue
+        for i in matched:
+          rule_ids[i] = rule_id
+        if len(matched) == len(remaining):
+          break
+        remaining = list(itertools.ifilterfalse(
+            set(matched).__contains__, remaining))
+    return rule_ids
+
+  def ClassKey(self, batch, i, rule_id):
+    """Return the stats key for packet i, matched by rule rule_id.
+
+    The key is (rule id, dst ip, port[, name field values]); ClassName
+    turns it into the class name string.
+    """
+    if rule_id < 0:
+      return None
+    dport = batch.dport[i]
+    if dport < 0:
+      dport = 0
+    rule = self.rules[rule_id]
+    if rule.fields:
+      return (rule_id, batch.dst_ip[i], dport, rule.FieldValues(batch, i))
+    return (rule_id, batch.dst_ip[i], dport)
+
+  def ClassName(self, key):
+    if key is None:
+      return None
+    if key not in self.names:
+      rule = self.rules[key[0]]
+      if rule.fields:
+        rule_name = rule.name_format % key[3]
+      else:
+        rule_name = rule.name
+      self.names[key] = '%s:%s|%d' % (rule_name, IpString(key[1]), key[2])
+    return self.names[key]
+
+
+class RulesFile(object):
+  """The --rules file and its Classifier, rebuilt when the file changes."""
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.mtime = None
+    if fname:
+      self.mtime = os.stat(fname).st_mtime
+      self.classifier = Classifier(open(fname).read(), fname)
+    else:
+      self.classifier = Classifier(DEFAULT_RULES, 'DEFAULT_RULES')
+
+  def CheckReload(self):
+    """Pick up changes to the rules file, keeping the old rules on error."""
+    if not self.fname:
+      return
+    try:
+      mtime = os.stat(self.fname).st_mtime
+      if mtime == self.mtime:
+        return
+      classifier = Classifier(open(self.fname).read(), self.fname)
+    except (IOError, OSError, RuleError), e:
+      print 'Not reloading rules: %s' % e
+      return
+    print 'Reloaded %d rules from %s' % (len(classifier.rules), self.fname)
+    self.mtime = mtime
+    self.classifier = classifier
+
+
+class PcapError(Exception):
+  pass
+
+
+class PacketBatch(object):
+  """A run of pcap records, with the IP/TCP/UDP/ICMP fields in columns.
+
+  Records are referenced by offset into the shared capture buffer rather
+  than copied out, and addresses are kept as 32-bit ints. sport/dport are
+  -1 when there's no transport header. flags and icmp_type are only
+  decoded when something asks for them.
+  """
+
+  def __init__(self, buf):
+    self.buf = buf
+    self.offset = array.array('l')
+    self.caplen = array.array('i')
+    self.pktlen = array.array('i')
+    self.timestamp = array.array('d')
+
+  def __len__(self):
+    return len(self.offset)
+
+  def Raw(self, i):
+    return self.buf[self.offset[i]:self.offset[i]+self.caplen[i]]
+
+  def Decode(self):
+    """Fill in the decoded columns."""
+    count = len(self.offset)
+    self.proto = array.array('B', [0]) * count
+    self.src_ip = array.array('l', [0]) * count
+    self.dst_ip = array.array('l', [0]) * count
+    self.sport = array.array('i', [-1]) * count
+    self.dport = array.array('i', [-1]) * count
+    # start of the TCP header / ICMP message, or -1
+    self.l4_offset = array.array('l', [-1]) * count
+    # records too short to hold an IP header are skipped
+    self.valid = array.array('B', [1]) * count
+    buf = self.buf
+    ip_unpack = IP_HEADER.unpack_from
+    ports_unpack = PORTS.unpack_from
+    for i in xrange(count):
+      ofs = self.offset[i] + ETH_HEADER_LEN
+      caplen = self.caplen[i]
+      if caplen < ETH_HEADER_LEN + IP_HEADER.size:
+        self.valid[i] = 0
+        continue
+      ver_ihl, frag, proto, src_ip, dst_ip = ip_unpack(buf, ofs)
+      self.proto[i] = proto
+      self.src_ip[i] = src_ip
+      self.dst_ip[i] = dst_ip
+      if proto == 1:
+        # the ICMP code stands in for the port
+        self.dport[i] = 0
+      if frag & 0x1f:
+        # not the first fragment, no transport header
+        continue
+      l4_ofs = (ver_ihl & 0x0f) << 2
+      l4_avail = caplen - ETH_HEADER_LEN - l4_ofs
+      if proto in (6, 17) and l4_avail >= 4:
+        self.sport[i], self.dport[i] = ports_unpack(buf, ofs + l4_ofs)
+        if proto == 6 and l4_avail >= 14:
+          self.l4_offset[i] = ofs + l4_ofs
+      elif proto == 1 and l4_avail >= 2:
+        self.l4_offset[i] = ofs + l4_ofs
+        self.dport[i] = ord(buf[ofs+l4_ofs+1])
+
+  def __getattr__(self, name):
+    if name not in ('flags', 'icmp_type'):
+      raise AttributeError(name)
+    # TCP flags are byte 13 of the header, the ICMP type is byte 0
+    column = array.array('B', [0]) * len(self.offset)
+    field_ofs = 13 if name == 'flags' else 0
+    proto = 6 if name == 'flags' else 1
+    buf = self.buf
+    for i, l4_offset in enumerate(self.l4_offset):
+      if l4_offset >= 0 and self.proto[i] == proto:
+        column[i] = ord(buf[l4_offset+field_ofs])
+    setattr(self, name, column)
+    return column
+
+
+class PcapReader(object):
+  """Walk the records of a pcap file in bulk through an mmap."""
+
+  def __init__(self, fname):
+    self.fh = open(fname, 'rb')
+    size = os.fstat(self.fh.fileno()).st_size
+    if size < PCAP_HEADER_LEN:
+      self.fh.close()
+      raise PcapError('%s: too short for a pcap header' % fname)
+    self.buf = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+    magic = self.buf[:4]
+    if magic not in PCAP_MAGIC:
+      self.Close()
+      raise PcapError('%s: not a pcap file (magic %r)' % (fname, magic))
+    self.byte_order, self.ts_divisor = PCAP_MAGIC[magic]
+
+  def Close(self):
+    self.buf.close()
+    self.fh.close()
+
+  def Chunks(self, chunk_bytes):
+    """Split the records into (start, end) offset ranges of ~chunk_bytes."""
+    buf = self.buf
+    end = len(buf)
+    record_unpack = struct.Struct(self.byte_order + '8xI4x').unpack_from
+    chunks = []
+    pos = start = PCAP_HEADER_LEN
+    while pos + PCAP_RECORD_LEN <= end:
+      pos += PCAP_RECORD_LEN + record_unpack(buf, pos)[0]
+      if pos - start >= chunk_bytes:
+        chunks.append((start, min(pos, end)))
+        start = pos
+    if start < end:
+      chunks.append((start, end))
+    return chunks
+
+  def Batches(self, batch_size, start=None, end=None):
+    """Yield decoded PacketBatch objects of up to batch_size records.
+
+    start and end, if given, must be record boundaries from Chunks.
+    """
+    buf = self.buf
+    end = end or len(buf)
+    record_unpack = struct.Struct(self.byte_order + 'IIII').unpack_from
+    pos = start or PCAP_HEADER_LEN
+    while pos + PCAP_RECORD_LEN <= end:
+      batch = PacketBatch(buf)
+      offsets, caplens, pktlens, stamps = (
+          batch.offset, batch.caplen, batch.pktlen, batch.timestamp)
+      while pos + PCAP_RECORD_LEN <= end and len(offsets) < batch_size:
+        ts_sec, ts_frac, caplen, pktlen = record_unpack(buf, pos)
+        pos += PCAP_RECORD_LEN
+        if pos + caplen > end:
+          print 'Truncated pcap record at offset %d' % (pos-PCAP_RECORD_LEN)
+          pos = end
+          break
+        offsets.append(pos)
+        caplens.append(caplen)
+        pktlens.append(pktlen)
+        stamps.append(ts_sec + ts_frac/self.ts_divisor)
+        pos += caplen
+      batch.Decode()
+      yield batch
+
+
+class GzipPcapReader(object):
+  """Stream the records of a gzip'd pcap, inflating on a separate thread.
+
+  zlib and file reads release the GIL, so the next blocks are decompressed
+  while the current one is being decoded. The stream can't be split into
+  Chunks, so a .pcap.gz always goes to a single worker.
+  """
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.fh = open(fname, 'rb')
+    self.blocks = Queue.Queue(GZIP_QUEUE_BLOCKS)
+    self.stop = threading.Event()
+    self.eof = False
+    self.thread = threading.Thread(target=self.Inflate)
+    self.thread.daemon = True
+    self.thread.start()
+    buf = ''
+    while len(buf) < PCAP_HEADER_LEN:
+      block = self.NextBlock()
+      if not block:
+        self.Close()
+        raise PcapError('%s: too short for a pcap header' % fname)
+      buf += block
+    magic = buf[:4]
+    if magic not in PCAP_MAGIC:
+      self.Close()
+      raise PcapError('%s: not a pcap file (magic %r)' % (fname, magic))
+    self.byte_order, self.ts_divisor = PCAP_MAGIC[magic]
+    # inflated data after the header that Batches hasn't seen yet
+    self.pending = buf[PCAP_HEADER_LEN:]
+
+  def Inflate(self):
+    """Decompress thread: queue inflated blocks, then None at the end."""
+    try:
+      # 16 + MAX_WBITS: expect a gzip header and trailer
+      inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      while not self.stop.is_set():
+        data = self.fh.read(GZIP_READ_LEN)
+        if not data:
+          break
+        while data:
+          block = inflater.decompress(data)
+          data = inflater.unused_data
+          if data:
+            # another gzip member follows, as from gzip -c >>
+            inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+          if block:
+            self.Put(block)
+      self.Put(inflater.flush())
+    except (IOError, zlib.error), e:
+      self.Put(e)
+    self.Put(None)
+
+  def Put(self, item):
+    # don't block forever if the reader was closed early
+    while not self.stop.is_set():
+      try:
+        self.blocks.put(item, timeout=0.1)
+        return
+      except Queue.Full:
+        pass
+
+  def NextBlock(self):
+    """Return the next inflated block, or '' at the end of the stream."""
+    if self.eof:
+      return ''
+    block = self.blocks.get()
+    if block is None or isinstance(block, Exception):
+      if block is not None:
+        print '%s: %s' % (self.fname, block)
+      self.eof = True
+      return ''
+    return block
+
+  def Close(self):
+    self.stop.set()
+    self.thread.join()
+    self.fh.close()
+
+  def Batches(self, batch_size, start=None, end=None):
+    """Yield decoded PacketBatch objects of up to batch_size records.
+
+    start and end are only there to match PcapReader; they must be None.
+    """
+    record_unpack = struct.Struct(self.byte_order + 'IIII').unpack_from
+    buf = self.pending
+    self.pending = ''
+    pos = 0
+    # uncompressed offset of buf, for error messages
+    buf_offset = PCAP_HEADER_LEN
+    while True:
+      batch = PacketBatch(buf)
+      offsets, caplens, pktlens, stamps = (
+          batch.offset, batch.caplen, batch.pktlen, batch.timestamp)
+      buf_len = len(buf)
+      while pos + PCAP_RECORD_LEN <= buf_len and len(offsets) < batch_size:
+        ts_sec, ts_frac, caplen, pktlen = record_unpack(buf, pos)
+        if caplen > MAX_CAPLEN:
+          print 'Bad pcap record length %d at offset %d' % (
+              caplen, buf_offset + pos)
+          self.eof = True
+          buf_len = pos
+          break
+        if pos + PCAP_RECORD_LEN + caplen > buf_len:
+          # the rest of the record is in the next block
+          break
+        pos += PCAP_RECORD_LEN
+        offsets.append(pos)
+        caplens.append(caplen)
+        pktlens.append(pktlen)
+        stamps.append(ts_sec + ts_frac/self.ts_divisor)
+        pos += caplen
+      if offsets:
+        batch.Decode()
+        yield batch
+      if len(offsets) == batch_size:
+        continue
+      block = self.NextBlock()
+      if not block:
+        if pos < buf_len:
+          print 'Truncated pcap record at offset %d' % (buf_offset + pos)
+        return
+      # carry the partial record over into the next block
+      buf = buf[pos:buf_len] + block
+      buf_offset += pos
+      pos = 0
+
+
+def OpenPcap(fname):
+  """Return a reader for fname, inflating it as it goes if it's .gz."""
+  if fname.endswith('.gz'):
+    return GzipPcapReader(fname)
+  return PcapReader(fname)
+
+
+def CaptureName(fname):
+  """The capture's own name; the same whether it's read compressed or not."""
+  prefix = os.path.basename(fname)
+  if prefix.endswith('.gz'):
+    prefix = prefix[:-3]
+  return prefix
+
+
+def SampleRate(fname):
+  """How many packets each one in the capture fname stands for."""
+  prefix = CaptureName(fname)
+  unused_fname_group, fname_date, unused_fname_time = prefix.split('-')
+  if 'sample' in fname:
+    if prefix.startswith('1'):
+      sample_size = 32.0
+    else:
+      sample_size = 128.0   # large packets
+  else:
+    sample_size = 1.0
+  skip_file = os.path.join(FLAGS.drop_stats_dir, fname_date, prefix)
+  if os.path.exists(skip_file):
+    result = open(skip_file).read()
+    if result:
+      rate = result.strip().split(' ')
+      sample_size *= (float(rate[2])+float(rate[1]))/float(rate[1])
+  return sample_size
+
+
+class PacketProcessing(object):
+
+  def __init__(self, classifier, pcap_writer=None):
     # classified objects
     self.stats = {}
-    if FLAGS.output_pcap:
-      print 'Writing unknown packets to %s' % FLAGS.output_pcap
-      self.pcap_writer = dpkt.pcap.Writer(open(FLAGS.output_pcap, 'w+'))
+    self.classifier = classifier
+    # packets handed over one at a time by libpcap, waiting for a batch
+    self.pending = []
+    self.pcap_writer = pcap_writer
+
+  def ReadFile(self, fname, start=None, end=None):
+    """Classify the packets in fname, or in one of its Chunks.
+
+    Returns False if the file couldn't be read.
+    """
+    try:
+      reader = OpenPcap(fname)
+    except IOError, e:
+      print e
+      return False
+    except PcapError, e:
+      # let libpcap deal with anything that isn't a plain pcap file
+      print '%s, reading through libpcap' % e
+      reader = None
+    if reader:
+      for batch in reader.Batches(FLAGS.batch_size, start, end):
+        self.ProcessBatch(batch)
+      reader.Close()
     else:
-      self.pcap_writer = None
+      p = pcap.pcapObject()
+      p.open_dead(1, 1600)
+      try:
+        p.open_offline(fname)
+      except Exception, e:
+        print e
+        return False
+      p.loop(-1, self.ProcessPacket)
+      self.FlushPending()
+    return True
 
   def ProcessPacket(self, pktlen, raw_pkt, timestamp):
-    pkt = Packet(raw_pkt, pktlen)
-    cls = Classification(pkt)
-    if cls.name not in self.stats:
-      self.stats[cls.name] = StatsGroup(
-          'sport', 'dport', 'dst_ip', 'src_ip', 'proto_dport', 'proto')
-    if not cls.name and self.pcap_writer:
-      self.pcap_writer.writepkt(raw_pkt, ts=timestamp)
-    stats = self.stats[cls.name]
-    stats.proto.add(pkt['proto'], pktlen)
-    stats.dst_ip.add(pkt['dst_ip'], pktlen)
-    stats.src_ip.add(pkt['src_ip'], pktlen)
-    if 'dport' in pkt.fields:
-      stats.dport.add(pkt['dport'], pktlen)
-      stats.proto_dport.add((pkt['proto'], pkt['dport']), pktlen)
-    if 'sport' in pkt.fields:
-      stats.sport.add(pkt['sport'], pktlen)
-
-  def ClearStats(self):
-    self.stats = {}
+    self.pending.append((pktlen, raw_pkt, timestamp))
+    if len(self.pending) >= FLAGS.batch_size:
+      self.FlushPending()
+
+  def FlushPending(self):
+    if not self.pending:
+      return
+    batch = PacketBatch(''.join(raw_pkt for _, raw_pkt, _ in self.pending))
+    offset = 0
+    for pktlen, raw_pkt, timestamp in self.pending:
+      batch.offset.append(offset)
+      batch.caplen.append(len(raw_pkt))
+      batch.pktlen.append(pktlen)
+      batch.timestamp.append(timestamp)
+      offset += len(raw_pkt)
+    self.pending = []
+    batch.Decode()
+    self.ProcessBatch(batch)
+
+  def ProcessBatch(self, batch):
+    self.AddBatchStats(batch, self.classifier.Classify(batch))
+
+  def AddBatchStats(self, batch, rule_ids):
+    class_key = self.classifier.ClassKey
+    for i in itertools.compress(xrange(len(batch)), batch.valid):
+      cls_key = class_key(batch, i, rule_ids[i])
+      if cls_key not in self.stats:
+        self.stats[cls_key] = StatsGroup(
+            'sport', 'dport', 'dst_ip', 'src_ip', 'proto_dport', 'proto',
+            sketch_size=FLAGS.sketch_size, distinct=DistinctStats())
+      if not cls_key and self.pcap_writer:
+        self.pcap_writer.writepkt(batch.Raw(i), ts=batch.timestamp[i])
+      stats = self.stats[cls_key]
+      pktlen = batch.pktlen[i]
+      proto = batch.proto[i]
+      stats.proto.add(proto, pktlen)
+      stats.dst_ip.add(batch.dst_ip[i], pktlen)
+      stats.src_ip.add(batch.src_ip[i], pktlen)
+      dport = batch.dport[i]
+      if dport >= 0:
+        stats.dport.add(dport, pktlen)
+        stats.proto_dport.add(proto << 16 | dport, pktlen)
+      sport = batch.sport[i]
+      if sport >= 0:
+        stats.sport.add(sport, pktlen)
+
+  def MergeStats(self, stats):
+    for cls_key, stats_group in stats.iteritems():
+      if cls_key not in self.stats:
+        self.stats[cls_key] = stats_group
+      else:
+        self.stats[cls_key].Merge(stats_group)
 
   def GetStatsFname(self, orig_fname):
-    prefix = os.path.basename(orig_fname)
+    prefix = CaptureName(orig_fname)
     fname_split = prefix.split('-')
     if len(fname_split) != 3:
       print prefix, fname_split
@@ -243,91 +1159,212 @@ class PacketProcessing(object):
   def SaveStats(self, orig_fname, stats_fname):
     if not stats_fname:
       return
-    prefix = os.path.basename(orig_fname)
+    prefix = CaptureName(orig_fname)
     fname_split = prefix.split('-')
-    unused_fname_group, fname_date, unused_fname_time = fname_split
+    unused_fname_group, fname_date, fname_time = fname_split
     stats_fh = open(stats_fname, 'w+')
-    if 'sample' in orig_fname:
-      if prefix.startswith('1'):
-        sample_size = 32.0
-      else:
-        sample_size = 128.0   # large packets
-    else:
-      sample_size = 1.0
-    skip_file = '/sdb2/stats.pcap/%s/%s' % (fname_date, prefix)
-    if os.path.exists(skip_file):
-      result = open(skip_file).read()
-      if result:
-        rate = result.strip().split(' ')
-        sample_size *= (float(rate[2])+float(rate[1]))/float(rate[1])
+    sample_size = SampleRate(orig_fname)
     print 'Writing stats to %s (sample rate: %.2f)' % (stats_fname, sample_size)
-    other = {}
-    for cls_name in self.stats:
-      if cls_name is None:
+    # name -> [pkts, bytes, {stat name: merged HyperLogLog}]
+    class_totals = {}
+    fields = DistinctStats()
+    for cls_key in self.stats:
+      print_name = self.classifier.ClassName(cls_key)
+      if print_name is None:
         print_name = 'Unclassified'
-      else:
-        print_name = cls_name
-      pkts, bytes = (self.stats[cls_name].proto.totals[0],
-                     self.stats[cls_name].proto.totals[1])
+      stats_group = self.stats[cls_key]
+      self.AddTotals(class_totals, print_name, stats_group.proto.totals,
+                     dict((element, stats_group.__dict__[element].distinct)
+                          for element in fields))
+    other = {}
+    rows = []
+    # sorted, so the output doesn't depend on the order packets were seen
+    for print_name in sorted(class_totals):
+      pkts, bytes, distinct = class_totals[print_name]
       if pkts <= 2 and ':' in print_name:
         # go ahead and combine things that saw <=2 packets during this interval
         other_name = ':'.join(print_name.split(':')[:-1])
         while other_name and other_name.endswith(':'):
           other_name = other_name[:-1]
-        if other_name not in other:
-          other[other_name] = [0, 0]
-        other[other_name][0] += pkts
-        other[other_name][1] += bytes
+        self.AddTotals(other, other_name, (pkts, bytes), distinct)
         continue
-      pkts *= sample_size
-      bytes *= sample_size
-      print >>stats_fh, '%s\t%d\t%d' % (print_name, pkts, bytes)
-    for other_name in other:
-      pkts, bytes = other[other_name]
-      pkts *= sample_size
-      bytes *= sample_size
-      print >>stats_fh, '%s\t%d\t%d' % (other_name, pkts, bytes)
+      rows.append((print_name, pkts, bytes, distinct))
+    for other_name in sorted(other):
+      pkts, bytes, distinct = other[other_name]
+      rows.append((other_name, pkts, bytes, distinct))
 
+    if FLAGS.stats_format == 'binary':
+      statsfile.Write(
+          stats_fh,
+          [(name, int(pkts * sample_size), int(bytes * sample_size), distinct)
+           for name, pkts, bytes, distinct in rows],
+          sample_size, (fname_date + fname_time)[:12], fields)
+    else:
+      for name, pkts, bytes, distinct in rows:
+        self.WriteStatsLine(stats_fh, name, pkts, bytes, distinct,
+                            sample_size)
     stats_fh.close()
 
+  def AddTotals(self, class_totals, name, totals, distinct):
+    if name not in class_totals:
+      class_totals[name] = [0, 0, dict(
+          (element, hyperloglog.HyperLogLog()) for element in distinct)]
+    class_totals[name][0] += totals[0]
+    class_totals[name][1] += totals[1]
+    for element in distinct:
+      class_totals[name][2][element].Merge(distinct[element])
+
+  def WriteStatsLine(self, stats_fh, name, pkts, bytes, distinct,
+                     sample_size):
+    # Distinct counts are of what's in the capture; they can't be scaled
+    # up for sampling like the packet and byte counts.
+    distinct_cols = ''.join(
+        '\tdistinct_%s=%d:%s' % (element, distinct[element].Estimate(),
+                                 distinct[element].Encode())
+        for element in DISTINCT_STATS if element in distinct)
+    print >>stats_fh, '%s\t%d\t%d%s' % (
+        name, pkts * sample_size, bytes * sample_size, distinct_cols)
+
   def PrintStats(self):
-    for cls_name in self.stats:
+    for cls_key in self.stats:
       print
-      print '*' * 30, cls_name, '*' * 30
-      if cls_name is None:
-        for statgroup in self.stats[cls_name].groups:
-          self.stats[cls_name].__getattribute__(statgroup).PrintStats()
+      print '*' * 30, self.classifier.ClassName(cls_key), '*' * 30
+      if cls_key is None:
+        for statgroup in self.stats[cls_key].groups:
+          self.stats[cls_key].__getattribute__(statgroup).PrintStats()
       else:
-        self.stats[cls_name].proto.PrintTotals()
+        self.stats[cls_key].proto.PrintTotals()
 
 
-def main(unused_argv):
-  global FLAGS
-  FLAGS = AP_FLAGS.parse_args()
-  pkt = PacketProcessing()
-  scapy.all.UDP.payload_guess = []
-  scapy.all.TCP.payload_guess = []
+# Classifiers in a --jobs worker process, by rules text
+WORKER_CLASSIFIERS = {}
+
+
+def AnalyzeChunk(task):
+  """Pool worker: classify a chunk of a file, returning its stats."""
+  fname, start, end, rules_text = task
+  if rules_text not in WORKER_CLASSIFIERS:
+    WORKER_CLASSIFIERS[rules_text] = Classifier(
+        rules_text, FLAGS.rules or 'DEFAULT_RULES')
+  pkt = PacketProcessing(WORKER_CLASSIFIERS[rules_text])
+  if not pkt.ReadFile(fname, start, end):
+    return fname, None
+  return fname, pkt.stats
+
+
+def SplitFile(fname, chunk_bytes):
+  if fname.endswith('.gz'):
+    # compressed streams can only be read from the start
+    return [(None, None)]
+  try:
+    reader = PcapReader(fname)
+  except (IOError, PcapError):
+    # the worker will report the problem
+    return [(None, None)]
+  if len(reader.buf) <= chunk_bytes:
+    chunks = [(None, None)]
+  else:
+    chunks = reader.Chunks(chunk_bytes)
+  reader.Close()
+  return chunks
+
+
+def AnalyzeSerial(rules, pcap_writer):
   for fname in FLAGS.input_files:
     print 'reading %s' % fname
+    rules.CheckReload()
+    pkt = PacketProcessing(rules.classifier, pcap_writer)
     stats_fname = pkt.GetStatsFname(fname)
     if not stats_fname:
       continue
     if os.path.exists(stats_fname) and not FLAGS.overwrite:
       continue
-    p = pcap.pcapObject()
-    p.open_dead(1, 1600)
-    try:
-      p.open_offline(fname)
-    except Exception, e:
-      print e
+    if not pkt.ReadFile(fname):
       continue
-    p.loop(-1, pkt.ProcessPacket)
     if FLAGS.detail:
       pkt.PrintStats()
     pkt.SaveStats(fname, stats_fname)
-    pkt.ClearStats()
-  if pkt.pcap_writer:
-    pkt.pcap_writer.close()
+
+
+def AnalyzeParallel(rules):
+  """Hand files, and chunks of large files, out to a pool of workers.
+
+  Results come back in order, so a file is saved as soon as its last
+  chunk is in, while the workers carry on with the next files.
+  """
+  pool = multiprocessing.Pool(FLAGS.jobs)
+  # fname -> [PacketProcessing, stats fname, chunks outstanding, read ok]
+  files = {}
+  # exc_info of an error in Tasks, to raise once the pool is done
+  errors = []
+  # a capture named twice is only read once, or its two runs would share
+  # (and clobber) the one entry in files
+  queued = set()
+
+  def Tasks():
+    # This runs in the pool's task thread, where an exception would leave
+    # imap hanging; it stops handing out tasks and main raises it instead.
+    try:
+      for fname in FLAGS.input_files:
+        if fname in queued:
+          continue
+        queued.add(fname)
+        print 'reading %s' % fname
+        rules.CheckReload()
+        pkt = PacketProcessing(rules.classifier)
+        stats_fname = pkt.GetStatsFname(fname)
+        if not stats_fname:
+          continue
+        if os.path.exists(stats_fname) and not FLAGS.overwrite:
+          continue
+        chunks = SplitFile(fname, FLAGS.chunk_mb << 20)
+        files[fname] = [pkt, stats_fname, len(chunks), True]
+        for start, end in chunks:
+          yield fname, start, end, rules.classifier.rules_text
+    except Exception:
+      errors.append(sys.exc_info())
+
+  for fname, stats in pool.imap(AnalyzeChunk, Tasks()):
+    state = files[fname]
+    pkt = state[0]
+    if stats is None:
+      state[3] = False
+    else:
+      pkt.MergeStats(stats)
+    state[2] -= 1
+    if state[2]:
+      continue
+    del files[fname]
+    if not state[3]:
+      continue
+    if FLAGS.detail:
+      pkt.PrintStats()
+    pkt.SaveStats(fname, state[1])
+  pool.close()
+  pool.join()
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def main(unused_argv):
+  global FLAGS
+  FLAGS = AP_FLAGS.parse_args()
+  rules = RulesFile(FLAGS.rules)
+  scapy.all.UDP.payload_guess = []
+  scapy.all.TCP.payload_guess = []
+  if FLAGS.jobs > 1:
+    if FLAGS.output_pcap:
+      print '--output_pcap is not supported with --jobs'
+      return
+    AnalyzeParallel(rules)
+    return
+  pcap_writer = None
+  if FLAGS.output_pcap:
+    print 'Writing unknown packets to %s' % FLAGS.output_pcap
+    pcap_writer = dpkt.pcap.Writer(open(FLAGS.output_pcap, 'w+'))
+  AnalyzeSerial(rules, pcap_writer)
+  if pcap_writer:
+    pcap_writer.close()
 
 
 def ExceptionInfo(ex_type, value, tb):
@@ -339,8 +1376,10 @@ def ExceptionInfo(ex_type, value, tb):
     pdb.pm()
 
 
-sys.excepthook = ExceptionInfo
-try:
-  main(sys.argv)
-except KeyboardInterrupt:
-  pass
+# importable, for file_analysis_bench.py
+if __name__ == '__main__':
+  sys.excepthook = ExceptionInfo
+  try:
+    main(sys.argv)
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,326 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark file_analysis.py on a synthetic capture of our traffic mix.
+
+Each stage of the pipeline (decode, classify, stats, save) is run over the
+whole capture in turn and timed on its own, so the decoded batches are held
+in memory between stages. Peak RSS is per stage where the kernel lets us
+reset the high-water mark, otherwise it's the peak so far.
+"""
+
+import argparse
+import bisect
+import gzip
+import os
+import random
+import resource
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+import file_analysis
+
+AP_FLAGS = argparse.ArgumentParser(description='File Analysis Benchmark')
+AP_FLAGS.add_argument('--packets', help='Packets in the synthetic capture',
+                      type=int, default=1000000)
+AP_FLAGS.add_argument('--seed', help='Random seed for the capture',
+                      type=int, default=1)
+AP_FLAGS.add_argument('--tmp_dir', help='Where to write the capture and '
+                      'stats (default: a new temp dir)', default='')
+AP_FLAGS.add_argument('--keep', help='Keep the capture and stats files in '
+                      'the temp dir',
+                      default=False, action='store_true')
+AP_FLAGS.add_argument('--gzip', help='Also time reading a .pcap.gz copy',
+                      default=False, action='store_true')
+AP_FLAGS.add_argument('--rules', help='Traffic class rules file '
+                      '(default: built-in rules)', default='')
+AP_FLAGS.add_argument('--batch_size', help='Packets to decode per batch',
+                      type=int, default=4096)
+AP_FLAGS.add_argument('--stats_format', help='As for file_analysis.py',
+                      default='tsv', choices=('tsv', 'binary'))
+AP_FLAGS.add_argument('--sketch_size', help='As for file_analysis.py',
+                      type=int, default=0)
+AP_FLAGS.add_argument('--distinct_counts', help='As for file_analysis.py',
+                      default=False, action='store_true')
+
+FLAGS = None
+
+# Named so file_analysis can find the date and time in it.
+CAPTURE_FNAME = 'bench-20131016-1200.pcap'
+CAPTURE_START = 1381924800  # 2013-10-16 12:00 UTC
+PACKETS_PER_SEC = 20000
+
+ETH_HEADER = ('\x00\x15\x17\xed\xa2\xe0\x00\x1f\x12\x8e\x00\x00\x08\x00')
+DESTINATIONS = ['1.1.1.1', '1.1.1.2', '1.1.1.77', '1.2.3.4', '1.2.3.9',
+                '1.0.0.1']
+# first octets of the btcentralplus sources, and some others
+SOURCE_NETS = [86, 81, 109, 217, 10, 24, 66, 200]
+
+
+def Frame(src, dst, proto, payload, frag=0):
+  """Ethernet + IPv4 frame, padded to the ethernet minimum."""
+  ip_header = struct.pack(
+      '!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 1, frag, 64, proto, 0,
+      socket.inet_aton(src), socket.inet_aton(dst))
+  frame = ETH_HEADER + ip_header + payload
+  if len(frame) < 60:
+    frame += '\x00' * (60 - len(frame))
+  return frame
+
+
+def Udp(sport, dport, payload):
+  return struct.pack('!HHHH', sport, dport, 8 + len(payload), 0) + payload
+
+
+def Tcp(sport, dport, flags):
+  return struct.pack('!HHIIBBHHH', sport, dport, 1, 0, 0x50, flags,
+                     8192, 0, 0)
+
+
+def FloodFfff(rnd, src, dst):
+  return Frame(src, dst, 17, Udp(rnd.randint(1024, 65535), 80,
+                                 '\xff' * rnd.randint(30, 100)))
+
+
+def Flood101(rnd, src, dst):
+  # the word at payload offset 8 and 10 comes back +0x101 at 24 and 26
+  word_a, word_b = rnd.randint(0, 0xfe00), rnd.randint(0, 0xfe00)
+  payload = struct.pack('!8xHH12xHH10x', word_a, word_b,
+                        word_a + 0x101, word_b + 0x101)
+  return Frame(src, dst, 17, Udp(rnd.randint(1024, 65535), 1234, payload))
+
+
+def BtcentralTime(rnd, dst):
+  src = '%d.%d.%d.%d' % (rnd.choice((86, 81, 109, 217)), rnd.randint(0, 255),
+                         rnd.randint(0, 255), rnd.randint(1, 254))
+  return Frame(src, dst, 17, Udp(rnd.randint(1024, 65535), 37, ''))
+
+
+def Noise(rnd, length):
+  """Payload bytes that won't look like one of the repeating floods."""
+  return (struct.pack('!Q', rnd.getrandbits(64)) * (length / 8 + 1))[:length]
+
+
+def Dns(rnd, src, dst):
+  query_id = struct.pack('!H', rnd.getrandbits(16))
+  if rnd.random() < 0.2:
+    return Frame(src, dst, 17, Udp(53, 53, query_id + '\x81\x80\x00\x01' +
+                                   Noise(rnd, 60)))
+  return Frame(src, dst, 17, Udp(rnd.randint(1024, 65535), 53,
+                                 query_id + '\x01\x00\x00\x01' +
+                                 Noise(rnd, 24)))
+
+
+def Sip(rnd, src, dst):
+  method = rnd.choice(('REGISTER', 'OPTIONS', 'INVITE'))
+  return Frame(src, dst, 17, Udp(5060, 5060, '%s sip:100@%s SIP/2.0\r\n'
+                                 'Via: SIP/2.0/UDP %s:5060\r\n\r\n' %
+                                 (method, dst, src)))
+
+
+def Mgcp(rnd, src, dst):
+  verb = 'RSIP' if rnd.random() < 0.7 else 'AUEP'
+  return Frame(src, dst, 17, Udp(2427, 2727, '%s %d aaln/1@gw MGCP 1.0\r\n' %
+                                 (verb, rnd.randint(1, 99999))))
+
+
+def TcpPacket(rnd, src, dst):
+  flags = rnd.choice((0x02, 0x02, 0x10, 0x10, 0x18, 0x11, 0x04, 0x14))
+  dport = rnd.choice((22, 80, 443, 8080, rnd.randint(1, 65535)))
+  return Frame(src, dst, 6, Tcp(rnd.randint(1024, 65535), dport, flags))
+
+
+def HotelNet(rnd, src):
+  return Frame(src, '1.2.3.4', 6, Tcp(rnd.randint(1024, 65535), 8888,
+                                      rnd.choice((0x02, 0x10, 0x18))))
+
+
+def Icmp(rnd, src, dst):
+  icmp_type = rnd.choice((0, 3, 8, 8, 11))
+  return Frame(src, dst, 1, struct.pack('!BBH', icmp_type, rnd.randint(0, 3),
+                                        0) + 'p' * 32)
+
+
+def Gre(rnd, src, dst):
+  return Frame(src, dst, 47, '\x00\x00\x08\x00' + 'g' * rnd.randint(20, 400))
+
+
+def OtherUdp(rnd, src, dst):
+  return Frame(src, dst, 17, Udp(rnd.randint(1, 65535),
+                                 rnd.choice((123, 161, 1900,
+                                             rnd.randint(1, 65535))),
+                                 Noise(rnd, rnd.randint(0, 1200))))
+
+
+# (relative weight, packet maker); makers take (rnd, src, dst)
+TRAFFIC_MIX = [
+    (20, FloodFfff),
+    (10, Flood101),
+    (8, lambda rnd, unused_src, dst: BtcentralTime(rnd, dst)),
+    (12, Dns),
+    (8, Sip),
+    (3, Mgcp),
+    (4, lambda rnd, src, unused_dst: HotelNet(rnd, src)),
+    (20, TcpPacket),
+    (5, Icmp),
+    (3, Gre),
+    (7, OtherUdp),
+]
+
+
+def WriteCapture(fname, packets, seed):
+  """Write a reproducible pcap of the TRAFFIC_MIX; returns its size."""
+  rnd = random.Random(seed)
+  cumulative = []
+  total = 0
+  for weight, _ in TRAFFIC_MIX:
+    total += weight
+    cumulative.append(total)
+  fh = open(fname, 'wb')
+  fh.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+  for i in xrange(packets):
+    maker = TRAFFIC_MIX[bisect.bisect(cumulative, rnd.random() * total)][1]
+    src = '%d.%d.%d.%d' % (rnd.choice(SOURCE_NETS), rnd.randint(0, 255),
+                           rnd.randint(0, 255), rnd.randint(1, 254))
+    frame = maker(rnd, src, rnd.choice(DESTINATIONS))
+    fh.write(struct.pack('<IIII', CAPTURE_START + i / PACKETS_PER_SEC,
+                         (i % PACKETS_PER_SEC) * (1000000 / PACKETS_PER_SEC),
+                         len(frame), len(frame)))
+    fh.write(frame)
+  fh.close()
+  return os.path.getsize(fname)
+
+
+def ResetPeakRss():
+  try:
+    # Linux 4.0+: reset VmHWM to the current RSS
+    fh = open('/proc/self/clear_refs', 'w')
+    fh.write('5')
+    fh.close()
+  except IOError:
+    pass
+
+
+def PeakRssMb():
+  try:
+    for line in open('/proc/self/status'):
+      if line.startswith('VmHWM:'):
+        return int(line.split()[1]) / 1024.0
+  except IOError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Stage(object):
+  """Times a block and records its peak RSS."""
+
+  def __init__(self, results, name):
+    self.results = results
+    self.name = name
+
+  def __enter__(self):
+    ResetPeakRss()
+    self.start = time.time()
+    return self
+
+  def __exit__(self, ex_type, unused_value, unused_tb):
+    if ex_type is None:
+      self.results.append((self.name, time.time() - self.start, PeakRssMb()))
+
+
+def PrintResults(results, packets, capture_bytes):
+  print '%-12s %8s %12s %9s %13s' % (
+      'stage', 'secs', 'packets/s', 'MB/s', 'peak RSS MB')
+  total_secs = 0.0
+  for name, secs, peak_rss in results:
+    total_secs += secs
+    secs = max(secs, 1e-6)
+    print '%-12s %8.2f %12.0f %9.1f %13.1f' % (
+        name, secs, packets / secs, capture_bytes / secs / 1e6, peak_rss)
+  if total_secs:
+    print '%-12s %8.2f %12.0f %9.1f' % (
+        'total', total_secs, packets / total_secs,
+        capture_bytes / total_secs / 1e6)
+
+
+def RunBenchmark(tmp_dir):
+  capture_fname = os.path.join(tmp_dir, CAPTURE_FNAME)
+  print 'Writing %d packets to %s' % (FLAGS.packets, capture_fname)
+  capture_bytes = WriteCapture(capture_fname, FLAGS.packets, FLAGS.seed)
+  rules = file_analysis.RulesFile(FLAGS.rules)
+  results = []
+
+  with Stage(results, 'decode'):
+    reader = file_analysis.PcapReader(capture_fname)
+    batches = list(reader.Batches(FLAGS.batch_size))
+  with Stage(results, 'classify'):
+    rule_ids = [rules.classifier.Classify(batch) for batch in batches]
+  pkt = file_analysis.PacketProcessing(rules.classifier)
+  with Stage(results, 'stats'):
+    for batch, batch_rule_ids in zip(batches, rule_ids):
+      pkt.AddBatchStats(batch, batch_rule_ids)
+  with Stage(results, 'save'):
+    pkt.SaveStats(capture_fname, pkt.GetStatsFname(capture_fname))
+  del batches, rule_ids, pkt
+  reader.Close()
+
+  if FLAGS.gzip:
+    gz_fname = capture_fname + '.gz'
+    src_fh = open(capture_fname, 'rb')
+    gz_fh = gzip.open(gz_fname, 'wb', 1)
+    shutil.copyfileobj(src_fh, gz_fh)
+    gz_fh.close()
+    src_fh.close()
+    with Stage(results, 'gzip decode'):
+      reader = file_analysis.GzipPcapReader(gz_fname)
+      for unused_batch in reader.Batches(FLAGS.batch_size):
+        pass
+      reader.Close()
+
+  print
+  PrintResults(results, FLAGS.packets, capture_bytes)
+
+
+def main(unused_argv):
+  global FLAGS
+  FLAGS = AP_FLAGS.parse_args()
+  tmp_dir = FLAGS.tmp_dir or tempfile.mkdtemp(prefix='file_analysis_bench')
+  # file_analysis reads its settings from its own FLAGS
+  file_analysis_args = [
+      '--output_stats_dir', tmp_dir, '--overwrite',
+      '--batch_size', str(FLAGS.batch_size),
+      '--sketch_size', str(FLAGS.sketch_size),
+      '--stats_format', FLAGS.stats_format, CAPTURE_FNAME]
+  if FLAGS.distinct_counts:
+    file_analysis_args.insert(0, '--distinct_counts')
+  file_analysis.FLAGS = file_analysis.AP_FLAGS.parse_args(file_analysis_args)
+  try:
+    RunBenchmark(tmp_dir)
+  finally:
+    if FLAGS.keep:
+      print 'Capture and stats left in %s' % tmp_dir
+    elif not FLAGS.tmp_dir:
+      shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for file_analysis."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import file_analysis
+
+
+class SampleRateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    file_analysis.FLAGS = file_analysis.AP_FLAGS.parse_args(
+        ['--drop_stats_dir', self.tmp_dir, 'input'])
+    os.mkdir(os.path.join(self.tmp_dir, '20131001'))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def testCompressedAndNot(self):
+    fname = '/finished/1sample-20131001-1200.pcap'
+    # onesniff names the drop counts after the uncompressed capture
+    skip_fh = open(os.path.join(self.tmp_dir, '20131001',
+                                '1sample-20131001-1200.pcap'), 'w')
+    skip_fh.write('0 100 300\n')
+    skip_fh.close()
+    self.assertEqual(32.0 * 4, file_analysis.SampleRate(fname))
+    self.assertEqual(32.0 * 4, file_analysis.SampleRate(fname + '.gz'))
+
+  def testNoDropCounts(self):
+    self.assertEqual(
+        128.0, file_analysis.SampleRate('/finished/2sample-20131001-1200.pcap'))
+    self.assertEqual(1.0, file_analysis.SampleRate(
+        '/finished/1full-20131001-1200.pcap.gz'))
+
+
+if __name__ == '__main__':
+  unittest.main()
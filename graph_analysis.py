@@ -16,16 +16,34 @@
 """Analyze and graph the sniffer data."""
 
 import argparse
+import array
+import bisect
 import collections
+import ctypes
+import ctypes.util
 import datetime
+import errno
 import hashlib
+import itertools
+import mmap
 import os
 import re
+import select
+import struct
 import subprocess
 import sys
 import time
 
-import blist
+try:
+  import matplotlib.dates
+  import matplotlib.figure
+  import matplotlib.ticker
+  from matplotlib.backends import backend_agg
+except ImportError:
+  matplotlib = None
+
+import hyperloglog
+import statsfile
 
 AP_FLAGS = argparse.ArgumentParser(description='Graph Analysis')
 AP_FLAGS.add_argument('--output_dir', help='Output dir',
@@ -43,6 +61,24 @@ AP_FLAGS.add_argument('--weekly', help='Run weekly',
                       default=False, action='store_true')
 AP_FLAGS.add_argument('--monthly', help='Run monthly',
                       default=False, action='store_true')
+AP_FLAGS.add_argument('--distinct_dir',
+                      help='Write distinct src/dst counts per graph here')
+AP_FLAGS.add_argument('--renderer', help='gnuplot, or matplotlib to draw the '
+                      'graphs in-process, without --tmp_dir files',
+                      default='gnuplot', choices=('gnuplot', 'matplotlib'))
+AP_FLAGS.add_argument('--render_jobs', help='gnuplot processes to run at once',
+                      type=int, default=4)
+AP_FLAGS.add_argument('--checkpoint_dir',
+                      help='Save the ingested stats here now and then, and '
+                      'start from them')
+AP_FLAGS.add_argument('--checkpoint_secs', help='Seconds between checkpoints',
+                      type=int, default=600)
+AP_FLAGS.add_argument('--rollup_dir',
+                      help='Keep a file per filter per finished day here, and '
+                      'read days from them instead of their .stats files')
+AP_FLAGS.add_argument('--full_resolution',
+                      help='Graph every 5 minute point, however long the '
+                      'window', default=False, action='store_true')
 
 FLAGS = None
 TOPN = 33
@@ -52,6 +88,41 @@ KEEP_PCT = 0.04
 
 DATE_RE = re.compile(r'-(20.*?)-(\d\d\d\d)\.')
 
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+INOTIFY_EVENT = struct.Struct('iIII')
+# A stats file still being written to after this long is taken as done.
+STATS_SETTLE_SECS = 30
+# Least seconds between renders of one graph, even if its data changed.
+RENDER_INTERVAL = {
+    'hourly': 10,
+    'daily': 60,
+    'weekly': 600,
+    'monthly': 1800,
+}
+# Render order; fresh short windows go ahead of the long ones.
+GRANULARITIES = ('hourly', 'daily', 'weekly', 'monthly')
+
+# Checkpoints (and daily rollups, in the same format) are a header, a
+# table of named sections and the sections,
+# each 8-byte aligned. Arrays are stored as-is, so only a build with the
+# same array('l') itemsize and byte order can read them back.
+CHECKPOINT_MAGIC = 'GACK'
+CHECKPOINT_VERSION = 1
+# magic, version, itemsize, byte order ('l'/'b'), number of sections
+CHECKPOINT_HEADER = struct.Struct('=4sIIcI')
+# name, offset, length
+CHECKPOINT_SECTION = struct.Struct('=8sQQ')
+
+# The width of the graphs in PLOT_COMMON, in pixels; longer series are
+# thinned out to about this many points.
+GRAPH_WIDTH = 1250
+
 PLOT_COMMON = """
 set timefmt "%Y%m%d-%H%M"
 set xdata time
@@ -73,108 +144,564 @@ set key below maxrows 10
 """
 
 
-class StatsProc(object):
-  def __init__(self, title, png_filename):
-    self.total_bytes = {}
-    self.total_pkts = {}
-    self.file_stats = {}
-    self.title = title
-    self.needs_render = False
-    self.png_filename = png_filename
+class KeyRegistry(object):
+  """Interns keys to small ints, for all the filters' stores.
 
-  def AddStats(self, fname):
-    self.needs_render = True
-    date_match = DATE_RE.search(fname)
-    if not date_match:
-      print 'cannot parse date from filename %s' % fname
+  Every key's ancestors in the ':' hierarchy are interned along with it, and
+  its parent's id, ':' separated parts and depth kept, so grouping and
+  walking up the hierarchy need no splitting.
+  """
+
+  def __init__(self):
+    self.ids = {}
+    self.keys = []
+    self.parents = array.array('l')  # -1 at the top
+    self.parts = []  # tuples
+    self.depths = array.array('l')  # number of parts
+    # size after the last Compact, to tell when to compact again
+    self.compacted_size = 0
+
+  def __len__(self):
+    return len(self.keys)
+
+  def Id(self, key):
+    key_id = self.ids.get(key)
+    if key_id is None:
+      parts = tuple(intern(part) for part in key.split(':'))
+      parent = (':'.join(parts[:-1])).rstrip(':')
+      parent_id = self.Id(parent) if parent else -1
+      key_id = self.ids[key] = len(self.keys)
+      self.keys.append(key)
+      self.parents.append(parent_id)
+      self.parts.append(parts)
+      self.depths.append(len(parts))
+    return key_id
+
+  def Parent(self, key):
+    """The nearest ancestor of key, or '' at the top."""
+    parent_id = self.parents[self.Id(key)]
+    return self.keys[parent_id] if parent_id >= 0 else ''
+
+  def Parts(self, key):
+    """key.split(':'), as a tuple."""
+    return self.parts[self.Id(key)]
+
+  def Depth(self, key):
+    """len(Parts(key))."""
+    return self.depths[self.Id(key)]
+
+  def Compact(self, stores):
+    """Forget the keys none of stores uses any more, renumbering the rest.
+
+    Looked at once the registry has doubled since it was last compacted,
+    and only done if that drops at least a quarter of it, so the
+    renumbering is paid for by the keys it drops.
+    """
+    if len(self.keys) < 2 * self.compacted_size + 1000:
       return
-    datestamp = (date_match.group(1), date_match.group(2))  # (yyyymmdd,hhmm)
-    try:
-      fh = open(fname)
-    except IOError, e:
-      print 'Cannot open file: %s' % e
+    t1s = time.time()
+    live = set()
+    for store in stores:
+      for day_totals in store.day_totals.itervalues():
+        live.update(day_totals)
+    compacted = KeyRegistry()
+    id_map = array.array('l', [-1]) * len(self.keys)
+    for key_id in sorted(live):
+      id_map[key_id] = compacted.Id(self.keys[key_id])
+    if len(compacted.keys) * 4 > len(self.keys) * 3:
+      self.compacted_size = len(self.keys)
       return
-    if datestamp not in self.file_stats:
-      self.file_stats[datestamp] = {}
-    for line in fh:
-      if not line:
-        continue
-      line_split = line.rstrip().split('\t')
-      if len(line_split) != 3:
+    for store in stores:
+      store.Remap(id_map)
+    print 'Compacted keys: %d to %d, %.1f sec' % (
+        len(self.keys), len(compacted.keys), time.time()-t1s)
+    self.ids = compacted.ids
+    self.keys = compacted.keys
+    self.parents = compacted.parents
+    self.parts = compacted.parts
+    self.depths = compacted.depths
+    self.compacted_size = len(self.keys)
+
+
+class SeriesStore(object):
+  """The 5-minute series for one filter, shared by all of its windows.
+
+  Keys are interned to ints by a KeyRegistry shared with the other filters.
+  Each 5-minute bucket is three parallel arrays (key id, pkts, bytes); a key
+  shows up more than once if several files land in the same bucket. Each
+  day also keeps a rollup of its totals, so a window's totals are a sum
+  over at most a month of days.
+  """
+
+  def __init__(self, keys):
+    self.keys = keys
+    # (yyyymmdd, hhmm) -> (key ids, pkts, bytes)
+    self.buckets = {}
+    # yyyymmdd -> {key id: [pkts, bytes]}
+    self.day_totals = {}
+    # yyyymmdd -> {key id: {'src_ip': HyperLogLog, ...}}
+    self.distinct = {}
+    self.distinct_fields = []  # in the order the .stats columns list them
+
+  def Add(self, datestamp, rows):
+    """Add the rows ReadStatsFile parsed from one file."""
+    day = datestamp[0]
+    if datestamp not in self.buckets:
+      self.buckets[datestamp] = (
+          array.array('l'), array.array('l'), array.array('l'))
+    ids, bucket_pkts, bucket_bytes = self.buckets[datestamp]
+    if day not in self.day_totals:
+      self.day_totals[day] = {}
+    day_totals = self.day_totals[day]
+    for key, pkts, bytes, distinct in rows:
+      key_id = self.keys.Id(key)
+      ids.append(key_id)
+      bucket_pkts.append(pkts)
+      bucket_bytes.append(bytes)
+      if key_id not in day_totals:
+        day_totals[key_id] = [0, 0]
+      day_totals[key_id][0] += pkts
+      day_totals[key_id][1] += bytes
+      if distinct:
+        self.AddDistinct(day, key_id, distinct)
+
+  def AddDistinct(self, day, key_id, distinct):
+    key_distinct = self.distinct.setdefault(day, {}).setdefault(key_id, {})
+    for field, hll in distinct:
+      if field not in self.distinct_fields:
+        self.distinct_fields.append(field)
+      if field not in key_distinct:
+        key_distinct[field] = hyperloglog.HyperLogLog()
+      key_distinct[field].Merge(hll)
+
+  def Datestamps(self, days):
+    """The buckets in these days, in time order."""
+    days = set(days)
+    return sorted(datestamp for datestamp in self.buckets
+                  if datestamp[0] in days)
+
+  def Totals(self, days):
+    """Return ({key: pkts}, {key: bytes}) summed over these days."""
+    totals = {}
+    for day in days:
+      for key_id, (pkts, bytes) in self.day_totals.get(day, {}).iteritems():
+        if key_id not in totals:
+          totals[key_id] = [0, 0]
+        totals[key_id][0] += pkts
+        totals[key_id][1] += bytes
+    keys = self.keys.keys
+    return (dict((keys[key_id], val[0]) for key_id, val in totals.iteritems()),
+            dict((keys[key_id], val[1]) for key_id, val in totals.iteritems()))
+
+  def Distinct(self, days):
+    """Return {key: {field: HyperLogLog}} merged over these days."""
+    distinct = {}
+    for day in days:
+      for key_id, key_distinct in self.distinct.get(day, {}).iteritems():
+        merged = distinct.setdefault(self.keys.keys[key_id], {})
+        for field, hll in key_distinct.iteritems():
+          if field not in merged:
+            merged[field] = hyperloglog.HyperLogLog()
+          merged[field].Merge(hll)
+    return distinct
+
+  def Evict(self, datestamp):
+    """Take a bucket back out of the store, and out of its day's totals.
+
+    Distinct counts can't be taken back out of a sketch, so the day's are
+    dropped for the caller to add back from what's left.
+    """
+    day = datestamp[0]
+    ids, bucket_pkts, bucket_bytes = self.buckets.pop(datestamp)
+    day_totals = self.day_totals[day]
+    for key_id, pkts, bytes in itertools.izip(ids, bucket_pkts, bucket_bytes):
+      day_totals[key_id][0] -= pkts
+      day_totals[key_id][1] -= bytes
+    live = set()
+    for other, bucket in self.buckets.iteritems():
+      if other[0] == day:
+        live.update(bucket[0])
+    if live:
+      for key_id in [key_id for key_id in day_totals if key_id not in live]:
+        del day_totals[key_id]
+    else:
+      del self.day_totals[day]
+    self.distinct.pop(day, None)
+
+  def AddStore(self, other, days=None):
+    """Add another store's data, or just that for these days, to this one.
+
+    Both stores have to be on the same KeyRegistry.
+    """
+    if days is None:
+      days = set(other.day_totals)
+    datestamps = sorted(datestamp for datestamp in other.buckets
+                        if datestamp[0] in days)
+    for datestamp in datestamps:
+      ids, bucket_pkts, bucket_bytes = other.buckets[datestamp]
+      if datestamp not in self.buckets:
+        self.buckets[datestamp] = (
+            array.array('l'), array.array('l'), array.array('l'))
+      bucket = self.buckets[datestamp]
+      bucket[0].extend(ids)
+      bucket[1].extend(bucket_pkts)
+      bucket[2].extend(bucket_bytes)
+    for day in days:
+      if day not in other.day_totals:
         continue
-      key, pkts, bytes = line_split[0], int(line_split[1]), int(line_split[2])
-      key = key.rstrip(':')
-      if key not in self.total_bytes:
-        self.total_bytes[key] = 0
-      self.total_bytes[key] += bytes
+      day_totals = self.day_totals.setdefault(day, {})
+      for key_id, (pkts, bytes) in other.day_totals[day].iteritems():
+        totals = day_totals.setdefault(key_id, [0, 0])
+        totals[0] += pkts
+        totals[1] += bytes
+      for key_id, key_distinct in other.distinct.get(day, {}).iteritems():
+        self.AddDistinct(day, key_id, key_distinct.items())
 
-      if key not in self.total_pkts:
-        self.total_pkts[key] = 0
-      self.total_pkts[key] += pkts
+  def Sections(self):
+    """Return the store as [(name, data)] checkpoint sections.
 
-      if key not in self.file_stats[datestamp]:
-        self.file_stats[datestamp][key] = [0, 0]
-      self.file_stats[datestamp][key][0] += pkts
-      self.file_stats[datestamp][key][1] += bytes
+    The keys are numbered afresh, over just the ones the store uses.
+    """
+    used = set()
+    for day_totals in self.day_totals.itervalues():
+      used.update(day_totals)
+    used = sorted(used)
+    key_map = array.array('l', [-1]) * len(self.keys)
+    for index, key_id in enumerate(used):
+      key_map[key_id] = index
+    datestamps = sorted(self.buckets)
+    sizes = array.array('l')
+    columns = (array.array('l'), array.array('l'), array.array('l'))
+    for datestamp in datestamps:
+      bucket = self.buckets[datestamp]
+      sizes.append(len(bucket[0]))
+      columns[0].extend(array.array('l', map(key_map.__getitem__, bucket[0])))
+      columns[1].extend(bucket[1])
+      columns[2].extend(bucket[2])
+    days = sorted(self.day_totals)
+    totals = array.array('l')  # (day index, key id, pkts, bytes)
+    for day_index, day in enumerate(days):
+      for key_id, (pkts, bytes) in self.day_totals[day].iteritems():
+        totals.extend((day_index, key_map[key_id], pkts, bytes))
+    distinct = []
+    for day, day_distinct in self.distinct.iteritems():
+      for key_id, key_distinct in day_distinct.iteritems():
+        for field, hll in key_distinct.iteritems():
+          distinct.append('%s\t%d\t%s\t%s' % (day, key_map[key_id], field,
+                                                hll.Encode()))
+    return [
+        ('keys', PackLines(self.keys.keys[key_id] for key_id in used)),
+        ('stamps', PackLines('%s-%s' % datestamp for datestamp in datestamps)),
+        ('sizes', sizes.tostring()),
+        ('ids', columns[0].tostring()),
+        ('pkts', columns[1].tostring()),
+        ('bytes', columns[2].tostring()),
+        ('days', PackLines(days)),
+        ('totals', totals.tostring()),
+        ('fields', PackLines(self.distinct_fields)),
+        ('distinct', PackLines(distinct)),
+    ]
 
-    fh.close()
+  def Restore(self, sections):
+    """Load what Sections returned into this empty store."""
+    key_map = array.array('l', map(self.keys.Id,
+                                   UnpackLines(sections['keys'])))
+    sizes, ids, pkts, bytes, totals = [
+        UnpackArray(sections[name])
+        for name in ('sizes', 'ids', 'pkts', 'bytes', 'totals')]
+    ids = array.array('l', map(key_map.__getitem__, ids))
+    start = 0
+    for stamp, size in itertools.izip(UnpackLines(sections['stamps']), sizes):
+      end = start + size
+      self.buckets[tuple(stamp.split('-'))] = (
+          ids[start:end], pkts[start:end], bytes[start:end])
+      start = end
+    days = UnpackLines(sections['days'])
+    for day in days:
+      self.day_totals[day] = {}
+    for index in xrange(0, len(totals), 4):
+      day_index, key_id, key_pkts, key_bytes = totals[index:index+4]
+      self.day_totals[days[day_index]][key_map[key_id]] = [key_pkts,
+                                                           key_bytes]
+    self.distinct_fields = UnpackLines(sections['fields'])
+    for line in UnpackLines(sections['distinct']):
+      day, key_id, field, encoded = line.split('\t')
+      self.distinct.setdefault(day, {}).setdefault(
+          key_map[int(key_id)], {})[field] = hyperloglog.Decode(encoded)
 
-  def GetCommonName(self, namea, nameb):
-    # namea - larger one to combine into
-    # nameb - smaller one to combine from
-    # UDP:flood:0xffff:1.1.1.1|80
-    nameasplit = namea.split(':')
-    namebsplit = nameb.split(':')
-    level_match = 0
-    level = 0
-    for level in xrange(4):
-      if len(nameasplit) <= level or len(namebsplit) <= level:
-        break
-      if nameasplit[level] != namebsplit[level]:
-        break
-      level_match += 1
-    combined_name = (':'.join(nameasplit[0:level])).rstrip(':')
-    return (level_match, combined_name)
+  def Remap(self, id_map):
+    """Renumber the key ids, after the KeyRegistry was compacted."""
+    for datestamp, bucket in self.buckets.iteritems():
+      self.buckets[datestamp] = (
+          array.array('l', map(id_map.__getitem__, bucket[0])),
+          bucket[1], bucket[2])
+    for day_dict in (self.day_totals, self.distinct):
+      for day, key_dict in day_dict.iteritems():
+        day_dict[day] = dict((id_map[key_id], val)
+                             for key_id, val in key_dict.iteritems())
+
+  def Truncate(self, first_day):
+    """Forget everything from before first_day (yyyymmdd)."""
+    for datestamp in [datestamp for datestamp in self.buckets
+                      if datestamp[0] < first_day]:
+      del self.buckets[datestamp]
+    for day_dict in (self.day_totals, self.distinct):
+      for day in [day for day in day_dict if day < first_day]:
+        del day_dict[day]
+
+
+class SortedBuckets(object):
+  """A sorted list.
+
+  It's kept as a list of short sorted lists, so adding and removing items
+  doesn't move everything after them.
+  """
+
+  LOAD = 500
+
+  def __init__(self, items=()):
+    """items, if any, must already be sorted."""
+    self.buckets = [items[start:start + self.LOAD]
+                    for start in xrange(0, len(items), self.LOAD)]
+    self.maxes = [bucket[-1] for bucket in self.buckets]
+
+  def __iter__(self):
+    return itertools.chain.from_iterable(self.buckets)
+
+  def Add(self, item):
+    index = bisect.bisect_left(self.maxes, item)
+    if index == len(self.buckets):
+      if not self.buckets:
+        self.buckets.append([])
+        self.maxes.append(None)
+      index -= 1
+      self.buckets[index].append(item)
+      self.maxes[index] = item
+    else:
+      bisect.insort(self.buckets[index], item)
+    bucket = self.buckets[index]
+    if len(bucket) > 2 * self.LOAD:
+      self.buckets[index:index + 1] = [bucket[:self.LOAD],
+                                       bucket[self.LOAD:]]
+      self.maxes[index:index + 1] = [bucket[self.LOAD - 1], bucket[-1]]
+
+  def Remove(self, item):
+    index = bisect.bisect_left(self.maxes, item)
+    bucket = self.buckets[index]
+    del bucket[bisect.bisect_left(bucket, item)]
+    if not bucket:
+      del self.buckets[index]
+      del self.maxes[index]
+    else:
+      self.maxes[index] = bucket[-1]
+
+  def After(self, item):
+    """The first item greater than item, or None."""
+    index = bisect.bisect_right(self.maxes, item)
+    if index == len(self.buckets):
+      return None
+    bucket = self.buckets[index]
+    return bucket[bisect.bisect_right(bucket, item)]
+
+
+class TopRowGroup(object):
+  """The rows GetTopRows is grouping, smallest first.
+
+  Among rows of a size, the last one added comes first. Besides all of the
+  rows in that order, the rows starting with the same 1-4 ':' separated
+  parts can be searched on their own.
+  """
+
+  START = (float('-inf'),)
+  END = (float('inf'),)
+
+  def __init__(self, keys, sizes, max_size, names):
+    """Starts out with names, as if Add()ed in that order.
+
+    keys is the KeyRegistry that splits the names.
+    """
+    self.keys = keys
+    self.sizes = sizes
+    self.max_size = max_size
+    self.entries = {}  # row -> Order(row)
+    self.adds = 0
+    self.big = set()  # rows over max_size
+    self.parts = {}  # row -> prefixes of its parts
+    # () -> all the entries, and (parts...) -> the ones for rows starting
+    # with those parts
+    by_prefix = collections.defaultdict(list)
+    for name in names:
+      self.adds += 1
+      entry = self.entries[name] = (sizes[name], -self.adds, name)
+      for prefix in self.Prefixes(name):
+        by_prefix[prefix].append(entry)
+      if sizes[name] > max_size:
+        self.big.add(name)
+    self.sorted = collections.defaultdict(SortedBuckets)
+    for prefix, entries in by_prefix.iteritems():
+      entries.sort()
+      self.sorted[prefix] = SortedBuckets(entries)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, name):
+    return name in self.entries
+
+  def Prefixes(self, name):
+    prefixes = self.parts.get(name)
+    if prefixes is None:
+      parts = self.keys.Parts(name)
+      prefixes = self.parts[name] = [
+          parts[:level] for level in xrange(min(self.keys.Depth(name), 4) + 1)]
+    return prefixes
+
+  def Order(self, name):
+    """What the rows are ordered by: (size, -number of adds, row)."""
+    return self.entries[name]
+
+  def Add(self, name):
+    self.adds += 1
+    entry = self.entries[name] = (self.sizes[name], -self.adds, name)
+    for prefix in self.Prefixes(name):
+      self.sorted[prefix].Add(entry)
+    if self.sizes[name] > self.max_size:
+      self.big.add(name)
+
+  def Discard(self, name):
+    entry = self.entries.pop(name, None)
+    if entry:
+      self.big.discard(name)
+      for prefix in self.Prefixes(name):
+        self.sorted[prefix].Remove(entry)
+
+  def Pop(self):
+    """Remove and return the smallest row."""
+    name = self.First((), self.START, self.END)
+    self.Discard(name)
+    return name
+
+  def First(self, prefix, after, before):
+    """The smallest row starting with prefix ordered after and before."""
+    rows = self.sorted.get(tuple(prefix))
+    entry = rows and rows.After(after)
+    if entry is None or entry >= before:
+      return None
+    return entry[2]
+
+  def Rows(self):
+    """The rows, largest first and the first added first among a size."""
+    rows = [entry[2] for entry in self.sorted[()]]
+    rows.reverse()
+    return rows
+
+
+class StatsProc(object):
+  """One graph: a window of days over a filter's SeriesStore."""
+
+  def __init__(self, title, png_filename, store, days):
+    self.store = store
+    self.days = days  # yyyymmdd strings
+    self.title = title
+    self.png_filename = png_filename
+    # count and order-independent hash of the files added to the window
+    self.num_inputs = 0
+    self.inputs_hash = 0
+    # key_name -> (rows, {key: row name}, keys past a regroup boundary), from
+    # the last time the rows were grouped
+    self.top_rows = {}
+
+  def AddInput(self, fname):
+    self.num_inputs += 1
+    self.inputs_hash = (self.inputs_hash +
+                        int(hashlib.md5(fname).hexdigest(), 16)) % (1 << 128)
+
+  def Fingerprint(self):
+    """Changes whenever the graph would come out differently."""
+    return (tuple(self.days), self.num_inputs, self.inputs_hash)
+
+  def CachedTopRows(self, key_name, totals):
+    """GetTopRows for totals, keeping the rows from the last render if it can.
+
+    The keys are only grouped afresh once a key folded into another row
+    grows past the smallest row or KEEP_PCT of the total, or a new key has
+    no row to go in; until then new keys join the row of their nearest
+    ancestor, or Other, and the rows keep their order and so their place
+    in the legend.
+    """
+    cached = self.top_rows.get(key_name)
+    if cached:
+      key_list, row_of, boundary = cached
+      rows = dict(key_list)
+      # keys since evicted may be gone from the registry too
+      for key in [key for key in row_of if key not in totals]:
+        rows[row_of.pop(key)].discard(key)
+      for key in totals:
+        if key in row_of or not key:
+          continue
+        ancestor = self.store.keys.Parent(key)
+        while ancestor and ancestor not in rows:
+          ancestor = self.store.keys.Parent(ancestor)
+        if ancestor not in rows:
+          break
+        rows[ancestor].add(key)
+        row_of[key] = ancestor
+      else:
+        if self.PastBoundary(totals, key_list, row_of) <= boundary:
+          return key_list
+    key_list = self.GetTopRows(totals, TOPN, KEEP_PCT)
+    row_of = {}
+    for row, keys in key_list:
+      for key in keys:
+        row_of[key] = row
+    self.top_rows[key_name] = (key_list, row_of,
+                               self.PastBoundary(totals, key_list, row_of))
+    return key_list
+
+  def PastBoundary(self, totals, key_list, row_of):
+    """The keys folded into another row that GetTopRows could have kept.
+
+    Those are the ones bigger than the smallest row or KEEP_PCT of the
+    total.
+    """
+    row_sizes = dict((row, 0) for row, _ in key_list)
+    for key, size in totals.iteritems():
+      row = row_of.get(key, '')
+      row_sizes[row] = row_sizes.get(row, 0) + size
+    row_sizes.pop('', None)
+    limit = min([sum(totals.itervalues()) * KEEP_PCT] + row_sizes.values())
+    return set(key for key, size in totals.iteritems()
+               if size > limit and row_of.get(key, '') != key)
 
   def GetTopRows(self, stats_group_orig, max_elements, max_size_pct):
-    # strategy:
-    #  - combine the smallest elements until we have max_elements left
+    """Group the keys of stats_group_orig into at most max_elements rows.
+
+    Until there are few enough rows, the smallest row is folded into its
+    parent if that's a row. Otherwise it's combined, under the name they
+    have in common, with the row FindPartner picks, or with none it goes
+    into Other ('').
+
+    Returns [(row name, set of keys in the row)], largest row first and
+    Other, if used, last.
+    """
     stats_group_size = dict(stats_group_orig)
-    stats_group = blist.sortedlist(
-        stats_group_orig, key=lambda x: -stats_group_size[x])
     max_size = sum(stats_group_size.values()) * max_size_pct
+    keys = self.store.keys
+    stats_group = TopRowGroup(keys, stats_group_size, max_size,
+                              stats_group_orig)
     stats_parents = collections.defaultdict(set)
     while len(stats_group) > max_elements:
-      combine = stats_group.pop()
-      combine_parent = (':'.join(combine.split(':')[:-1])).rstrip(':')
-      if len(stats_group)&0x7fff == 0:
-        print 'processing', combine, len(stats_group), len(stats_group_size)
-      common_name = None
-      best_level = None
-      best_common_name = ''
+      combine = stats_group.Pop()
+      combine_parent = keys.Parent(combine)
       best_parta = None
       # check for a short-circuit (see if the one-level-up value exists
       if combine_parent in stats_group_size:
         best_common_name = combine_parent
       else:
-        for index in xrange(len(stats_group)-1, -1, -1):
-          parta = stats_group[index]
-          level_match, common_name = self.GetCommonName(parta, combine)
-          if common_name != parta and stats_group_size[parta] > max_size:
-            # this one is too big, don't do it.
-            break
-          if (best_level is None or level_match > best_level or
-              common_name == parta):
-            if (best_common_name and
-                best_common_name == best_parta and best_level == level_match):
-              # already have an exact match, no better than this one.
-              continue
-            if level_match <= best_level and common_name != parta:
-              # less good of a level, not an exact match.
-              continue
-            best_level = level_match
-            best_common_name = common_name
-            best_parta = parta
+        best_parta = self.FindPartner(stats_group, combine)
+        best_common_name = ''
+        if best_parta is not None:
+          best_common_name = self.GetCommonName(best_parta, combine)[1]
         if not best_common_name:
           best_parta = None  # only combine with other, nothing else
         if best_common_name not in stats_group_size:
@@ -182,44 +709,87 @@ class StatsProc(object):
           if best_common_name:
             # Do not add 'other', we sum that up later. This
             # avoids putting stuff in 'other' if it can go anywhere else.
-            stats_group.add(best_common_name)
+            stats_group.Add(best_common_name)
         elif best_common_name == combine:
           # add it back
-          stats_group.add(best_common_name)
+          stats_group.Add(best_common_name)
       if combine != best_common_name:
         # remove and add it back after the size is updated to keep it sorted.
-        stats_group.discard(best_common_name)
-        stats_group_size[best_common_name] += stats_group_size[combine]
+        stats_group.Discard(best_common_name)
+        stats_group_size[best_common_name] += stats_group_size.pop(combine)
         if best_common_name:
-          stats_group.add(best_common_name)
-
+          stats_group.Add(best_common_name)
         stats_parents[best_common_name].add(combine)
-        del stats_group_size[combine]
       if best_common_name != best_parta and best_parta:
-        stats_group.discard(best_common_name)
-        stats_group_size[best_common_name] += stats_group_size[best_parta]
+        stats_group.Discard(best_common_name)
+        stats_group_size[best_common_name] += stats_group_size.pop(best_parta)
         if best_common_name:
-          stats_group.add(best_common_name)
-
+          stats_group.Add(best_common_name)
         stats_parents[best_common_name].add(best_parta)
-        stats_group.discard(best_parta)
-        del stats_group_size[best_parta]
-    expanded_stats = []
-    # convert to a list so we can add in Other at the end that isn't sorted.
-    stats_group = list(stats_group)
+        stats_group.Discard(best_parta)
+    # Other isn't one of the rows, it goes at the end
+    row_names = stats_group.Rows()
     if '' in stats_group_size:
-      stats_group.append('')
-    found_eg = set()
+      row_names.append('')
     estat_dict = {}
-    for sg in sorted(stats_group, key=lambda x: -x.count(':')):
-      expanded_group = self.GetExpandedGroup(sg, stats_parents,
+    for sg in row_names:
+      estat_dict[sg] = self.GetExpandedGroup(sg, stats_parents,
                                              stats_group_orig)
-      for eg in expanded_group:
-        found_eg.add(eg)
-      estat_dict[sg] = expanded_group
-    for sg in stats_group:
-      expanded_stats.append((sg, estat_dict[sg]))
-    return expanded_stats
+    return [(sg, estat_dict[sg]) for sg in row_names]
+
+  def FindPartner(self, stats_group, combine):
+    """The row the smallest row, combine, gets combined with, or None.
+
+    Going through the rows from the smallest up, that's the last one that
+    GetCommonName matched on more levels than the ones picked before it, or
+    that is a prefix of combine, until the first row over max_size that
+    isn't a prefix of combine.
+    """
+    parts = self.store.keys.Parts(combine)
+    depth = self.store.keys.Depth(combine)
+    limit = stats_group.END
+    for parta in stats_group.big:
+      if self.GetCommonName(parta, combine)[1] != parta:
+        limit = min(limit, stats_group.Order(parta))
+    # the prefixes of combine that are rows always get picked, so only the
+    # rows between them are compared by level
+    prefixes = []
+    for level in xrange(min(depth - 1, 3) + 1):
+      parta = ':'.join(parts[:level])
+      if (parta in stats_group and
+          self.GetCommonName(parta, combine)[1] == parta and
+          stats_group.Order(parta) < limit):
+        prefixes.append((stats_group.Order(parta), level, parta))
+    best_parta, best_level, after = None, -1, stats_group.START
+    for before, level, parta in sorted(prefixes) + [(limit, None, None)]:
+      while best_level < min(depth, 4):
+        found = stats_group.First(parts[:best_level + 1], after, before)
+        if found is None:
+          break
+        best_parta, after = found, stats_group.Order(found)
+        best_level = self.GetCommonName(found, combine)[0]
+      if parta is not None:
+        best_parta, best_level, after = parta, level, before
+    return best_parta
+
+  def GetCommonName(self, namea, nameb):
+    # namea - larger one to combine into
+    # nameb - smaller one to combine from
+    # UDP:flood:0xffff:1.1.1.1|80
+    keys = self.store.keys
+    nameasplit = keys.Parts(namea)
+    namebsplit = keys.Parts(nameb)
+    depth = min(keys.Depth(namea), keys.Depth(nameb))
+    level_match = 0
+    level = 0
+    for level in xrange(4):
+      if depth <= level:
+        break
+      if nameasplit[level] != namebsplit[level]:
+        break
+      level_match += 1
+    combined_name = (':'.join(nameasplit[0:level])).rstrip(':')
+    return (level_match, combined_name)
 
   def GetExpandedGroup(self, sg_name, parents, orig_group):
     val = set()
@@ -233,176 +803,772 @@ class StatsProc(object):
     return val
 
   def _WritePng(self, output_dir, key_name, totals, stats_offset,
-                title, png_filename, interval=300.0, multiplier=1.0):
-    data_fname = '%s/gnuplot.data.%s.%d' % (
-        FLAGS.tmp_dir, key_name, os.getpid())
-    plot_cfg_fname = '%s/gnuplot.plotcfg.%s.%d' % (
-        FLAGS.tmp_dir, key_name, os.getpid())
-    data_fh = open(data_fname, 'w+')
-    cfg_fh = open(plot_cfg_fname, 'w+')
-
-    data_log_fname = '%s/gnuplot.log.data.%s.%d' % (
-        FLAGS.tmp_dir, key_name, os.getpid())
-    data_log_fh = open(data_log_fname, 'w+')
-    plot_cfg_log_fname = '%s/gnuplot.log.plotcfg.%s.%d' % (
-        FLAGS.tmp_dir, key_name, os.getpid())
+                title, png_filename, renderer, interval=300.0,
+                multiplier=1.0):
     print 'TOTAL', len(totals)
     t1s = time.time()
-    key_list = self.GetTopRows(totals, TOPN, KEEP_PCT)
+    key_list = self.CachedTopRows(key_name, totals)
     print 'GetTopRows: %d sec' % (time.time()-t1s)
     t1s = time.time()
 
     print 'Writing %s' % png_filename
-    file_list = list(self.file_stats)
-    file_list.sort()
-    expanded_rec = {}
-    for key, expanded_set in key_list:
+    store = self.store
+    file_list = store.Datestamps(self.days)
+    # key id -> row in key_list
+    expanded_rec = array.array('l', [-1]) * len(store.keys)
+    for index, (key, expanded_set) in enumerate(key_list):
       for expanded in expanded_set:
-        expanded_rec[expanded] = key
+        key_id = store.keys.ids.get(expanded)
+        if key_id is not None:
+          expanded_rec[key_id] = index
     print 'Key setup: %d sec' % (time.time()-t1s)
     t1s = time.time()
-    for datestamp in file_list:
-      gnuplot_line = [('%s-%s' % (datestamp[0], datestamp[1]))]
-      gnuplot_log_line = [('%s-%s' % (datestamp[0], datestamp[1]))]
-      this_datapoint = 0.0
-      fsd = self.file_stats[datestamp]
-      agg_total = collections.defaultdict(float)
-      for fsinfo, val in fsd.iteritems():
-        agg_total[expanded_rec[fsinfo]] += val[stats_offset]
-      for key, expanded in key_list:
-        stats = agg_total[key]
-        # Stack the graphs
-        this_datapoint += multiplier*stats/interval
-        gnuplot_line.append('%.2f' % (this_datapoint))
-        gnuplot_log_line.append('%.2f' % (multiplier*stats/interval))
-      print >>data_fh, ' '.join(gnuplot_line)
-      print >>data_log_fh, ' '.join(gnuplot_log_line)
-    data_fh.close()
-    data_log_fh.close()
+    rates = self.GetRates(file_list, expanded_rec, len(key_list),
+                          stats_offset, interval, multiplier)
+    if FLAGS.full_resolution:
+      stacked_list, stacked_rates = file_list, rates
+      log_list, log_rates = file_list, rates
+    else:
+      stacked_list, stacked_rates = AverageRows(file_list, rates, GRAPH_WIDTH)
+      log_list, log_rates = PeakRows(file_list, rates, GRAPH_WIDTH)
+    labels = [key or 'Other' for key, _ in key_list]
+    colors = [self.GetColorHash(key) for key, _ in key_list]
+    ylabel = '%s-per-second' % key_name
+    name = '%s.%s' % (png_filename, self.days[0])
+    renderer.Plot('%s/%s-log.png' % (output_dir, png_filename), name,
+                  '%s (Logscale)' % title, ylabel, labels, colors,
+                  log_list, log_rates, stacked=False)
+    renderer.Plot('%s/%s-stacked.png' % (output_dir, png_filename), name,
+                  '%s (Stacked)' % title, ylabel, labels, colors,
+                  stacked_list, [StackRow(row) for row in stacked_rates],
+                  stacked=True)
+    print 'Plot: %d sec' % (time.time()-t1s)
 
-    print 'Gnuplot data file writer: %d sec' % (time.time()-t1s)
-    t1s = time.time()
+  def GetRates(self, datestamps, expanded_rec, num_rows, stats_offset,
+               interval, multiplier):
+    """Return the per-second rate of each row, one list per datestamp.
 
-    # create stacked graph
+    Each bucket's key columns are summed into the rows expanded_rec maps
+    their key ids to.
+    """
+    buckets = self.store.buckets
+    rates = []
+    for datestamp in datestamps:
+      bucket = buckets[datestamp]
+      # summing as ints is exact and quicker than floats
+      agg_total = [0] * num_rows
+      for key_id, val in itertools.izip(bucket[0], bucket[1+stats_offset]):
+        agg_total[expanded_rec[key_id]] += val
+      rates.append([multiplier*stats/interval for stats in agg_total])
+    return rates
+
+  def GetColorHash(self, key):
+    hashdigest = map(ord, hashlib.md5(key).digest())
+    while len(hashdigest) > 3:
+      if sum(hashdigest[:3]) < 64 or sum(hashdigest[:3]) > 256*3-64:
+        # too dark or too light
+        hashdigest = hashdigest[1:]
+      break
+    return '%02x%02x%02x' % tuple(hashdigest[:3])
+
+  def WriteImage(self, output_dir, renderer):
+    """Plot the packet and bit rate graphs with renderer."""
+    total_pkts, total_bytes = self.store.Totals(self.days)
+    self._WritePng(output_dir, 'packets', total_pkts, 0,
+                   title=self.title+' Packets',
+                   png_filename=self.png_filename+'-pps', renderer=renderer)
+    self._WritePng(output_dir, 'bits', total_bytes, 1,
+                   title=self.title+' Bitrate',
+                   png_filename=self.png_filename+'-bps', renderer=renderer,
+                   multiplier=8.0)
+    if FLAGS.distinct_dir:
+      self.WriteDistinct(FLAGS.distinct_dir)
+
+  def WriteDistinct(self, output_dir):
+    # Kept out of the graphs dir; graph_cgi treats everything there as an image
+    fields = self.store.distinct_fields
+    rows = []
+    for key, key_distinct in self.store.Distinct(self.days).iteritems():
+      rows.append((key, [key_distinct[field].Estimate()
+                         if field in key_distinct else 0
+                         for field in fields]))
+    rows.sort(key=lambda row: (-sum(row[1]), row[0]))
+    fname = '%s/%s-distinct.txt' % (output_dir, self.png_filename)
+    print 'Writing %s' % fname
+    fh = open(fname + '.tmp', 'w')
+    print >>fh, '\t'.join(['#key'] + fields)
+    for key, estimates in rows:
+      print >>fh, '\t'.join([key or 'Other'] + ['%d' % x for x in estimates])
+    fh.close()
+    os.rename(fname + '.tmp', fname)
+
+
+def AverageRows(datestamps, rows, width):
+  """Average runs of rows, to leave at most width of them.
+
+  Returns (datestamps, rows); each run is dated by its first datestamp.
+  """
+  step = -(-len(rows) // width)
+  if step <= 1:
+    return datestamps, rows
+  run_datestamps = []
+  run_rows = []
+  for start in xrange(0, len(rows), step):
+    run = rows[start:start+step]
+    run_datestamps.append(datestamps[start])
+    run_rows.append([total / len(run) for total in map(sum, zip(*run))])
+  return run_datestamps, run_rows
+
+
+def PeakRows(datestamps, rows, width):
+  """Cut runs of rows down to each series' low and high, to leave <= width.
+
+  Each run becomes two rows, dated by its first and last datestamps, so
+  spikes still show on the log graph. A series' low and high go in the
+  order they happened.
+  """
+  step = -(-len(rows) // (width // 2))
+  if step <= 1:
+    return datestamps, rows
+  run_datestamps = []
+  run_rows = []
+  for start in xrange(0, len(rows), step):
+    run = rows[start:start+step]
+    if len(run) == 1:
+      run_datestamps.append(datestamps[start])
+      run_rows.append(run[0])
+      continue
+    first = []
+    second = []
+    for series in zip(*run):
+      low = min(xrange(len(series)), key=series.__getitem__)
+      high = max(xrange(len(series)), key=series.__getitem__)
+      first.append(series[min(low, high)])
+      second.append(series[max(low, high)])
+    run_datestamps.extend([datestamps[start], datestamps[start+len(run)-1]])
+    run_rows.extend([first, second])
+  return run_datestamps, run_rows
+
+
+def StackRow(row):
+  """Running sums of row, so each series sits on top of the ones before."""
+  stacked = []
+  total = 0.0
+  for val in row:
+    total += val
+    stacked.append(total)
+  return stacked
+
+
+def WriteSeries(fh, datestamps, rows):
+  """Write a gnuplot data file: one line per datestamp with its row."""
+  if not rows:
+    return
+  line_fmt = '%s-%s' + ' %.2f' * len(rows[0]) + '\n'
+  fh.writelines(line_fmt % (datestamp + tuple(row))
+                for datestamp, row in itertools.izip(datestamps, rows))
+
+
+class GnuplotRenderer(object):
+  """Plots with gnuplot, from data and plot config files in --tmp_dir."""
+
+  def __init__(self, max_jobs):
+    self.pool = RenderPool(max_jobs)
+
+  def Plot(self, image, name, title, ylabel, labels, colors, datestamps,
+           rows, stacked):
+    """Queue a graph of rows, one column per label, to be drawn to image.
+
+    name tells this graph's temp files apart; stacked rows are running
+    sums, filled in between.
+    """
+    kind = '' if stacked else 'log.'
+    data_fname = '%s/gnuplot.%sdata.%s.%d' % (
+        FLAGS.tmp_dir, kind, name, os.getpid())
+    cfg_fname = '%s/gnuplot.%splotcfg.%s.%d' % (
+        FLAGS.tmp_dir, kind, name, os.getpid())
+    # gnuplot writes next to the real image, which is renamed over when done
+    tmp_image = TmpImageName(image)
+    data_fh = open(data_fname, 'w+')
+    WriteSeries(data_fh, datestamps, rows)
+    data_fh.close()
+
+    cfg_fh = open(cfg_fname, 'w+')
     print >>cfg_fh, 'plot \\'
-    for index, (key, _) in enumerate(key_list):
-      key_color = self.GetColorHash(key)
-      if not key:
-        key = 'Other'
-      if index:
+    for index, (label, color) in enumerate(zip(labels, colors)):
+      if not stacked:
+        print >>cfg_fh, ('%s"%s" using 1:%d title "%s" with lines '
+                         'lw %.1f lc rgb "#%s" \\' %
+                         (' , ' if index else ' ', data_fname, index+2,
+                          label, 1.5, color))
+      elif index:
         print >>cfg_fh, (' , "%s" using 1:%d:%d title "%s" with filledcurve '
                          'closed lc rgb "#%s" \\' %
-                         (data_fname, index+2, index+1, key, key_color))
+                         (data_fname, index+2, index+1, label, color))
       else:
         print >>cfg_fh, (' "%s" using 1:%d title "%s" with filledcurve '
                          'y1=0 lc rgb "#%s"\\' %
-                         (data_fname, index+2, key, key_color))
+                         (data_fname, index+2, label, color))
     print >>cfg_fh, ''
     print >>cfg_fh, PLOT_COMMON
-    print >>cfg_fh, STACKED_PLOT_COMMON
-    print >>cfg_fh, 'set ylabel "%s-per-second"' % key_name
-    print >>cfg_fh, 'set title "%s (Stacked)"' % title
-    print >>cfg_fh, 'set output "%s/%s-stacked.png' % (output_dir, png_filename)
+    print >>cfg_fh, STACKED_PLOT_COMMON if stacked else LOG_PLOT_COMMON
+    print >>cfg_fh, 'set ylabel "%s"' % ylabel
+    print >>cfg_fh, 'set title "%s"' % title
+    print >>cfg_fh, 'set output "%s"' % tmp_image
     print >>cfg_fh, 'replot'
     cfg_fh.close()
+    self.pool.Start(GnuplotJob(cfg_fname, tmp_image, image, [data_fname]))
 
-    # create log graph
-    cfg_fh = open(plot_cfg_log_fname, 'w+')
-    print >>cfg_fh, 'plot \\'
-    for index, (key, _) in enumerate(key_list):
-      key_color = self.GetColorHash(key)
-      if not key:
-        key = 'Other'
-      lweight = 1.5
-      if index:
-        print >>cfg_fh, (' , "%s" using 1:%d title "%s" with lines '
-                         'lw %.1f lc rgb "#%s" \\' %
-                         (data_log_fname, index+2, key, lweight, key_color))
+  def Wait(self):
+    self.pool.Wait()
+
+
+class MatplotlibRenderer(object):
+  """Plots in-process with matplotlib, straight from the rows.
+
+  The graphs follow PLOT_COMMON and its stacked and log variants.
+  """
+
+  def Plot(self, image, name, title, ylabel, labels, colors, datestamps,
+           rows, stacked):
+    """Draw a graph of rows, one column per label, to image.
+
+    Takes the same arguments as GnuplotRenderer.Plot.
+    """
+    if not rows:
+      return
+    fig = matplotlib.figure.Figure(figsize=(12.5, 7), dpi=100)
+    backend_agg.FigureCanvasAgg(fig)
+    fig.subplots_adjust(left=0.06, right=0.98, top=0.95, bottom=0.25)
+    axes = fig.add_subplot(1, 1, 1)
+    times = matplotlib.dates.date2num([
+        datetime.datetime.strptime(day + hhmm, '%Y%m%d%H%M')
+        for day, hhmm in datestamps])
+    below = [0.0] * len(times)
+    for label, color, series in itertools.izip(labels, colors, zip(*rows)):
+      if stacked:
+        axes.fill_between(times, below, series, facecolor='#' + color,
+                          linewidth=0, label=label)
+        below = series
       else:
-        print >>cfg_fh, (' "%s" using 1:%d title "%s" with lines '
-                         'lw %.1f lc rgb "#%s" \\' %
-                         (data_log_fname, index+2, key, lweight, key_color))
-    print >>cfg_fh, ''
-    print >>cfg_fh, PLOT_COMMON
-    print >>cfg_fh, LOG_PLOT_COMMON
-    print >>cfg_fh, 'set ylabel "%s-per-second"' % key_name
-    print >>cfg_fh, 'set title "%s (Logscale)"' % title
-    print >>cfg_fh, 'set output "%s/%s-log.png' % (output_dir, png_filename)
-    print >>cfg_fh, 'replot'
+        axes.plot(times, series, color='#' + color, linewidth=1.5,
+                  label=label)
+    if stacked:
+      axes.set_ylim(bottom=0)
+    else:
+      axes.set_yscale('log', basey=2)
+      axes.set_ylim(bottom=0.001)
+    axes.xaxis_date()
+    axes.margins(x=0)
+    axes.xaxis.set_major_formatter(
+        matplotlib.dates.DateFormatter('%a %m/%d %H:%M'))
+    axes.yaxis.set_major_formatter(matplotlib.ticker.EngFormatter(places=1))
+    axes.tick_params(labelsize=6)
+    axes.grid(True)
+    axes.set_title(title, fontsize=6)
+    axes.set_ylabel(ylabel, fontsize=6)
+    # like gnuplot's "set key below maxrows 10"
+    axes.legend(loc='upper center', bbox_to_anchor=(0.5, -0.06),
+                ncol=max(1, -(-len(labels) // 10)), fontsize=6,
+                frameon=False)
+    tmp_image = TmpImageName(image)
+    fig.savefig(tmp_image, format='png')
+    InstallImage(tmp_image, image)
 
+  def Wait(self):
+    """Nothing to wait for; Plot draws the graph before returning."""
+
+
+class GnuplotJob(object):
+  """One gnuplot run: a plot config in, an image out."""
+
+  def __init__(self, cfg_fname, tmp_image, image, tmp_files):
+    self.cfg_fname = cfg_fname
+    self.tmp_image = tmp_image
+    self.image = image
+    # removed with the config once the image is made
+    self.tmp_files = tmp_files
+    self.proc = None
+
+  def Start(self):
+    cfg_fh = open(self.cfg_fname)
+    self.proc = subprocess.Popen(['/usr/local/bin/gnuplot'], stdin=cfg_fh)
     cfg_fh.close()
-    cfg_fh = open(plot_cfg_log_fname)
-    p1 = subprocess.Popen(['/usr/local/bin/gnuplot'], stdin=cfg_fh)
-    cfg_fh.close()
-    cfg_fh = open(plot_cfg_fname)
-    p2 = subprocess.Popen(['/usr/local/bin/gnuplot'], stdin=cfg_fh)
-    cfg_fh.close()
-    p1.wait()
-    p2.wait()
-    DeleteIfEmpty('%s/%s-log.png' % (output_dir, png_filename))
-    DeleteIfEmpty('%s/%s-stacked.png' % (output_dir, png_filename))
-    print 'Gnuplot exec: %d sec' % (time.time()-t1s)
+
+  def Finish(self):
+    InstallImage(self.tmp_image, self.image)
+    for fname in [self.cfg_fname] + self.tmp_files:
+      os.unlink(fname)
+
+
+class RenderPool(object):
+  """Runs GnuplotJobs, at most max_jobs at a time.
+
+  Starting a job only blocks while the pool is full, so the next graph's
+  data files get written while the last ones are being plotted.
+  """
+
+  def __init__(self, max_jobs):
+    self.max_jobs = max(1, max_jobs)
+    self.running = []
+
+  def Start(self, job):
+    # windows sharing an image (hourly, around midnight) take turns, so
+    # the last one started is the one that's kept
+    while (len(self.running) >= self.max_jobs or
+           job.image in [running.image for running in self.running]):
+      self.Reap()
+    job.Start()
+    self.running.append(job)
+
+  def Reap(self):
+    """Wait for at least one running job to exit, and finish it."""
+    while True:
+      done = [job for job in self.running if job.proc.poll() is not None]
+      if done:
+        break
+      time.sleep(0.05)
+    for job in done:
+      self.running.remove(job)
+      job.Finish()
+
+  def Wait(self):
+    if not self.running:
+      return
     t1s = time.time()
-    os.unlink(data_fname)
-    os.unlink(data_log_fname)
-    os.unlink(plot_cfg_fname)
-    os.unlink(plot_cfg_log_fname)
+    while self.running:
+      self.Reap()
+    print 'Gnuplot exec: %d sec' % (time.time()-t1s)
 
-  def GetColorHash(self, key):
-    hashdigest = map(ord, hashlib.md5(key).digest())
-    while len(hashdigest) > 3:
-      if sum(hashdigest[:3]) < 64 or sum(hashdigest[:3]) > 256*3-64:
-        # too dark or too light
-        hashdigest = hashdigest[1:]
-      break
-    return '%02x%02x%02x' % tuple(hashdigest[:3])
 
-  def WriteImage(self, output_dir):
-    self._WritePng(output_dir, 'packets', self.total_pkts, 0,
-                   title=self.title+' Packets',
-                   png_filename=self.png_filename+'-pps')
-    self._WritePng(output_dir, 'bits', self.total_bytes, 1,
-                   title=self.title+' Bitrate',
-                   png_filename=self.png_filename+'-bps', multiplier=8.0)
+def PackLines(lines):
+  return ''.join(line + '\n' for line in lines)
+
 
+def UnpackLines(data):
+  return data.split('\n')[:-1]
 
-def DeleteIfEmpty(fname):
+
+def UnpackArray(data):
+  values = array.array('l')
+  values.fromstring(data)
+  return values
+
+
+def WriteCheckpoint(fname, sections):
+  """Write [(name, data)] to fname, replacing it in one step."""
+  offset = CHECKPOINT_HEADER.size + CHECKPOINT_SECTION.size * len(sections)
+  table = []
+  for name, data in sections:
+    offset += -offset % 8
+    table.append(CHECKPOINT_SECTION.pack(name, offset, len(data)))
+    offset += len(data)
+  fh = open(fname + '.tmp', 'wb')
+  fh.write(CHECKPOINT_HEADER.pack(
+      CHECKPOINT_MAGIC, CHECKPOINT_VERSION, array.array('l').itemsize,
+      sys.byteorder[0], len(sections)))
+  fh.write(''.join(table))
+  for name, data in sections:
+    fh.write('\0' * (-fh.tell() % 8))
+    fh.write(data)
+  fh.close()
+  os.rename(fname + '.tmp', fname)
+
+
+def ReadCheckpoint(fname):
+  """Return {name: data} from a checkpoint, or None if there's none usable."""
   try:
-    statf = os.stat(fname)
-    if not statf.st_size:
-      os.unlink(fname)
-  except IOError:
-    pass
+    fh = open(fname, 'rb')
+  except IOError, e:
+    if e.errno != errno.ENOENT:
+      print 'Could not read checkpoint %s: %s' % (fname, e)
+    return None
+  try:
+    mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+  except (mmap.error, ValueError), e:
+    print 'Could not read checkpoint %s: %s' % (fname, e)
+    return None
+  finally:
+    fh.close()
+  try:
+    magic, version, itemsize, byteorder, count = (
+        CHECKPOINT_HEADER.unpack_from(mapped))
+    if (magic, version, itemsize, byteorder) != (
+        CHECKPOINT_MAGIC, CHECKPOINT_VERSION, array.array('l').itemsize,
+        sys.byteorder[0]):
+      print 'Ignoring checkpoint %s: written by another version' % fname
+      return None
+    sections = {}
+    for index in xrange(count):
+      name, offset, length = CHECKPOINT_SECTION.unpack_from(
+          mapped, CHECKPOINT_HEADER.size + index * CHECKPOINT_SECTION.size)
+      if offset + length > len(mapped):
+        print 'Ignoring checkpoint %s: truncated' % fname
+        return None
+      sections[name.rstrip('\0')] = mapped[offset:offset+length]
+    return sections
+  except struct.error, e:
+    print 'Ignoring checkpoint %s: %s' % (fname, e)
+    return None
+  finally:
+    mapped.close()
+
+
+def TmpImageName(fname):
+  """A name in fname's dir that graph_cgi.py won't list (it skips dotfiles)."""
+  return os.path.join(os.path.dirname(fname),
+                      '.%s.tmp' % os.path.basename(fname))
+
+
+def InstallImage(tmp_fname, fname):
+  """Rename a finished image into place; an empty one is dropped."""
+  try:
+    if os.path.getsize(tmp_fname):
+      os.rename(tmp_fname, fname)
+    else:
+      os.unlink(tmp_fname)
+  except OSError, e:
+    print 'Could not install %s: %s' % (fname, e)
+
+
+def ReadStatsFile(fname):
+  """Parse a .stats file into ((yyyymmdd, hhmm), rows), or None.
+
+  rows are (key, pkts, bytes, distinct); distinct is a list of
+  (field, HyperLogLog) when --distinct_dir is set.
+  """
+  date_match = DATE_RE.search(fname)
+  if not date_match:
+    print 'cannot parse date from filename %s' % fname
+    return None
+  datestamp = (date_match.group(1), date_match.group(2))  # (yyyymmdd,hhmm)
+  try:
+    fh = open(fname)
+  except IOError, e:
+    print 'Cannot open file: %s' % e
+    return None
+  if fh.read(len(statsfile.MAGIC)) == statsfile.MAGIC:
+    fh.seek(0)
+    data = fh.read()
+    fh.close()
+    return datestamp, ReadBinaryStats(fname, data)
+  fh.seek(0)
+  rows = []
+  for line in fh:
+    if not line:
+      continue
+    line_split = line.rstrip().split('\t')
+    if len(line_split) < 3:
+      continue
+    key, pkts, bytes = line_split[0], int(line_split[1]), int(line_split[2])
+    distinct = None
+    if FLAGS.distinct_dir:
+      distinct = ParseDistinct(line_split[3:])
+    rows.append((key.rstrip(':'), pkts, bytes, distinct))
+  fh.close()
+  return datestamp, rows
+
+
+def ReadBinaryStats(fname, data):
+  """The rows of a statsfile.py format file, as ReadStatsFile returns them."""
+  try:
+    unused_time, unused_rate, names, pkts, bytes, distinct = (
+        statsfile.Read(data))
+  except ValueError, e:
+    print 'Cannot read %s: %s' % (fname, e)
+    return []
+  keys = [name.rstrip(':') for name in names]
+  if not FLAGS.distinct_dir or not distinct:
+    return zip(keys, pkts, bytes, itertools.repeat(None))
+  fields = [field for field, _ in distinct]
+  sketches = [[(field, hyperloglog.Decode(encoded))
+               for field, encoded in zip(fields, row)]
+              for row in zip(*[encoded for _, encoded in distinct])]
+  return zip(keys, pkts, bytes, sketches)
+
+
+def ParseDistinct(columns):
+  # columns look like distinct_src_ip=<estimate>:<encoded sketch>
+  distinct = []
+  for column in columns:
+    if not column.startswith('distinct_') or ':' not in column:
+      continue
+    field, encoded = column[len('distinct_'):].split(':', 1)
+    distinct.append((field.split('=')[0], hyperloglog.Decode(encoded)))
+  return distinct
+
+
+class StatsIngest(object):
+  """Read each new stats file once, for every view that wants it."""
+
+  def __init__(self, views):
+    self.views = views
+
+  def AddFiles(self, new_files):
+    # dir -> [files read, last one]
+    dir_counts = collections.OrderedDict()
+    for full_path in new_files:
+      dirpath, fname = os.path.split(full_path)
+      views = [view for view in self.views if view.WantFile(full_path)]
+      if not views:
+        continue
+      parsed = ReadStatsFile(full_path)
+      if dirpath not in dir_counts:
+        dir_counts[dirpath] = [0, fname]
+      dir_counts[dirpath][0] += 1
+      dir_counts[dirpath][1] = fname
+      if dir_counts[dirpath][0]%250 == 0:
+        print 'Processing stats in dir: %s (%d files, last %s)' % (
+            dirpath, dir_counts[dirpath][0], fname)
+      for view in views:
+        view.AddFile(full_path, parsed)
+    for dirpath, (file_count, fname) in dir_counts.iteritems():
+      if file_count%250 != 0:
+        print 'Processing stats in dir: %s (%d files, last %s)' % (
+            dirpath, file_count, fname)
+
+
+class StatsWatcher(object):
+  """Find stats files as they're finished, without walking the tree.
+
+  The tree is input_dir/yyyymmdd/*.stats. It's walked once at startup;
+  after that new files come from inotify, or where that isn't available,
+  from re-listing today's and yesterday's dirs when their mtime changes.
+  New files are put on self.new_files, oldest first.
+  """
+
+  def __init__(self, input_dir):
+    self.input_dir = input_dir
+    self.new_files = collections.deque()
+    self.seen = set()
+    # files that have shown up but may still be being written
+    self.unfinished = set()
+    self.dir_mtimes = {}
+    self.inotify_fd = None
+    # inotify watch descriptor -> dir
+    self.watches = {}
+    self.libc = None
+    try:
+      self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      fd = self.libc.inotify_init1(IN_NONBLOCK)
+      if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1')
+      self.inotify_fd = fd
+      self.AddWatch(input_dir)
+    except (AttributeError, OSError), e:
+      print 'No inotify (%s), watching dir mtimes' % e
+      self.inotify_fd = None
+    for dirname in sorted(os.listdir(input_dir)):
+      self.AddDir(os.path.join(input_dir, dirname))
+
+  def AddWatch(self, dirname):
+    wd = self.libc.inotify_add_watch(
+        self.inotify_fd, dirname,
+        IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_Q_OVERFLOW)
+    if wd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_add_watch %s' % dirname)
+    self.watches[wd] = dirname
+
+  def AddDir(self, dirname):
+    """Start watching a date dir, and queue what's in it already."""
+    if not os.path.isdir(dirname):
+      return
+    if self.inotify_fd is not None:
+      try:
+        self.AddWatch(dirname)
+      except OSError, e:
+        # probably out of watches; poll instead
+        print 'Cannot watch %s (%s), watching dir mtimes' % (dirname, e)
+        os.close(self.inotify_fd)
+        self.inotify_fd = None
+    self.ListDir(dirname)
+
+  def ListDir(self, dirname):
+    try:
+      self.dir_mtimes[dirname] = os.stat(dirname).st_mtime
+      fnames = os.listdir(dirname)
+    except OSError, e:
+      print 'Cannot list %s: %s' % (dirname, e)
+      return
+    for fname in sorted(fnames):
+      self.AddFile(os.path.join(dirname, fname), finished=False)
+
+  def AddFile(self, full_path, finished):
+    if full_path in self.seen or not full_path.endswith('.stats'):
+      return
+    if finished:
+      # an empty file was only touched, or its writer gave up early; wait
+      # for it to be written like any other unfinished one
+      try:
+        finished = os.stat(full_path).st_size > 0
+      except OSError:
+        return
+    if not finished:
+      self.unfinished.add(full_path)
+      return
+    self.unfinished.discard(full_path)
+    self.seen.add(full_path)
+    self.new_files.append(full_path)
+
+  def CheckUnfinished(self):
+    now = time.time()
+    for full_path in sorted(self.unfinished):
+      try:
+        statf = os.stat(full_path)
+      except OSError:
+        self.unfinished.discard(full_path)
+        continue
+      if statf.st_size and statf.st_mtime + STATS_SETTLE_SECS <= now:
+        self.AddFile(full_path, finished=True)
+
+  def ReadEvents(self):
+    while self.inotify_fd is not None:
+      try:
+        data = os.read(self.inotify_fd, 65536)
+      except OSError, e:
+        if e.errno == errno.EAGAIN:
+          return
+        raise
+      pos = 0
+      while pos < len(data):
+        wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, pos)
+        pos += INOTIFY_EVENT.size
+        name = data[pos:pos+name_len].rstrip('\0')
+        pos += name_len
+        if mask & IN_Q_OVERFLOW:
+          self.Rescan()
+          continue
+        if wd not in self.watches or not name:
+          continue
+        full_path = os.path.join(self.watches[wd], name)
+        if self.watches[wd] == self.input_dir:
+          if mask & IN_ISDIR:
+            self.AddDir(full_path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+          self.AddFile(full_path, finished=True)
+        else:
+          # created, not written yet
+          self.AddFile(full_path, finished=False)
+
+  def Rescan(self):
+    """Events were lost; find out what changed the slow way."""
+    watched = set(self.watches.values())
+    for dirname in sorted(os.listdir(self.input_dir)):
+      dirname = os.path.join(self.input_dir, dirname)
+      if dirname in watched:
+        self.ListDir(dirname)
+      else:
+        self.AddDir(dirname)
+
+  def CheckDirMtimes(self):
+    """Without inotify: re-list any recent dir whose contents changed."""
+    today = datetime.date.today()
+    dirnames = [os.path.join(self.input_dir, day.strftime('%Y%m%d'))
+                for day in (today - datetime.timedelta(1), today)]
+    try:
+      if os.stat(self.input_dir).st_mtime != self.dir_mtimes.get(
+          self.input_dir):
+        self.dir_mtimes[self.input_dir] = os.stat(self.input_dir).st_mtime
+        for dirname in sorted(os.listdir(self.input_dir)):
+          dirname = os.path.join(self.input_dir, dirname)
+          if dirname not in self.dir_mtimes:
+            dirnames.append(dirname)
+    except OSError, e:
+      print 'Cannot list %s: %s' % (self.input_dir, e)
+    for dirname in dirnames:
+      try:
+        mtime = os.stat(dirname).st_mtime
+      except OSError:
+        continue
+      if mtime != self.dir_mtimes.get(dirname):
+        self.ListDir(dirname)
+
+  def Wait(self, timeout):
+    """Wait up to timeout secs for new files, queueing any found."""
+    end = time.time() + timeout
+    while True:
+      if self.inotify_fd is not None:
+        self.ReadEvents()
+      else:
+        self.CheckDirMtimes()
+      if self.unfinished:
+        self.CheckUnfinished()
+      remaining = end - time.time()
+      if self.new_files or remaining <= 0:
+        return
+      if self.inotify_fd is not None and not self.unfinished:
+        select.select([self.inotify_fd], [], [], remaining)
+      else:
+        time.sleep(min(remaining, 1.0))
+
+  def NewFiles(self):
+    """Take everything off the queue."""
+    new_files = list(self.new_files)
+    self.new_files.clear()
+    return new_files
 
 
 def main(unused_argv):
   global FLAGS
   FLAGS = AP_FLAGS.parse_args()
+  keys = KeyRegistry()
   stats = []
-  stats.append(ProcessStats(FLAGS.input_dir, '', subtitle='All subnets'))
+  stats.append(ProcessStats(FLAGS.input_dir, '', keys,
+                            subtitle='All subnets'))
   stats.append(ProcessStats(
-      FLAGS.input_dir, '1.1.1.0', subtitle='Filter: 1.1.1.x'))
+      FLAGS.input_dir, '1.1.1.0', keys, subtitle='Filter: 1.1.1.x'))
   stats.append(ProcessStats(
-      FLAGS.input_dir, '1.2.3.0', subtitle='Filter: 1.2.3.x'))
+      FLAGS.input_dir, '1.2.3.0', keys, subtitle='Filter: 1.2.3.x'))
   stats.append(ProcessStats(
-      FLAGS.input_dir, '1.0.0.0', subtitle='Filter: 1.0.0.x'))
+      FLAGS.input_dir, '1.0.0.0', keys, subtitle='Filter: 1.0.0.x'))
+  ingest = StatsIngest(stats)
+  for state_dir in (FLAGS.checkpoint_dir, FLAGS.rollup_dir):
+    if state_dir and not os.path.exists(state_dir):
+      os.makedirs(state_dir)
+  if FLAGS.checkpoint_dir:
+    for stat in stats:
+      stat.LoadCheckpoint(FLAGS.checkpoint_dir)
+  if FLAGS.rollup_dir:
+    for stat in stats:
+      stat.LoadRollups(FLAGS.rollup_dir)
+  last_checkpoint = 0
+  watcher = StatsWatcher(FLAGS.input_dir)
+  if FLAGS.renderer == 'matplotlib':
+    if not matplotlib:
+      AP_FLAGS.error('--renderer=matplotlib needs matplotlib installed')
+    renderer = MatplotlibRenderer()
+  else:
+    renderer = GnuplotRenderer(FLAGS.render_jobs)
+  watcher.Wait(0)
   while True:
+    ingest.AddFiles(watcher.NewFiles())
+    windows = []
     for stat in stats:
-      print 'scanning... (%s)' % stat.subtitle
-      # Only do a sigle dir if we're doing hourly/daily-only,
-      # to allow faster cleanup
-      if FLAGS.daily or FLAGS.weekly or FLAGS.monthly:
-        stat.ScanNewFiles(single_dir=False)
       if FLAGS.hourly:
-        stat.ScanHourlyFiles()
-      stat.RenderStats()
+        stat.UpdateHourly()
+      windows.extend(stat.WindowsToRender())
+    print 'rendering... (%d graphs)' % len(windows)
+    windows.sort(key=lambda window: GRANULARITIES.index(window[0]))
+    for _, window in windows:
+      window.WriteImage(FLAGS.output_dir, renderer)
+    renderer.Wait()
+    for stat in stats:
       stat.AgeOutStats()
-    time.sleep(10)
+      if FLAGS.rollup_dir:
+        stat.WriteRollups(FLAGS.rollup_dir)
+    keys.Compact([store for stat in stats
+                  for store in (stat.store, stat.hourly_store)])
+    if (FLAGS.checkpoint_dir and
+        time.time() - last_checkpoint >= FLAGS.checkpoint_secs):
+      for stat in stats:
+        stat.SaveCheckpoint(FLAGS.checkpoint_dir)
+      last_checkpoint = time.time()
+    watcher.Wait(10)
 
 
 class ProcessStats(object):
 
-  def __init__(self, input_dir, fname_match, subtitle=''):
+  def __init__(self, input_dir, fname_match, keys, subtitle=''):
     self.input_dir = input_dir
     self.fname_match = fname_match
     self.subtitle = subtitle
@@ -410,22 +1576,38 @@ class ProcessStats(object):
     self.daily_stats = {}
     self.weekly_stats = {}
     self.monthly_stats = {}
-    self.processed_files = {}
+    # one copy of the data behind the daily, weekly and monthly windows
+    self.keys = keys
+    self.store = SeriesStore(keys)
+    self.processed_files = set()
+    # yyyymmdd -> the processed files from its directory
+    self.day_files = {}
+    # yyyymmdd -> how many files went into the day's rollup
+    self.rolled_up = {}
+    # (yyyymmdd, hhmm) -> [(full path, parsed)] for the files from the last
+    # 65 minutes, which are what's in hourly_store
+    self.hourly_buckets = {}
+    self.hourly_store = SeriesStore(keys)
+    # (png_filename, days) -> (fingerprint, time) of the window's last render
+    self.rendered = {}
     if self.fname_match:
       self.fname_suffix = '-' + self.fname_match
     else:
       self.fname_suffix = '-all'
 
   def TooOld(self, fname):
-    if FLAGS.scan_all_dates:
-      return False
     date_match = DATE_RE.search(fname)
     if not date_match:
       return False
     yyyymmdd, hhmm = date_match.group(1), date_match.group(2)
-    dt = datetime.datetime(
+    return self.TimeTooOld(datetime.datetime(
         int(yyyymmdd[:4]), int(yyyymmdd[4:6]), int(yyyymmdd[6:8]),
-        int(hhmm[:2]), int(hhmm[2:4]))
+        int(hhmm[:2]), int(hhmm[2:4])))
+
+  def TimeTooOld(self, dt):
+    """Whether no long window needs data from the datetime dt."""
+    if FLAGS.scan_all_dates:
+      return False
     now = datetime.datetime.now()
     if FLAGS.monthly and (now-dt).days < 32:
       return False
@@ -435,36 +1617,185 @@ class ProcessStats(object):
       return False
     return True
 
-  def RenderStats(self):
-    if FLAGS.hourly:
-      for stat in self.hourly_stats.values():
-        if stat.needs_render:
-          stat.WriteImage(FLAGS.output_dir)
-    if FLAGS.daily:
-      for stat in self.daily_stats.values():
-        if stat.needs_render:
-          stat.WriteImage(FLAGS.output_dir)
-    if FLAGS.weekly:
-      for stat in self.weekly_stats.values():
-        if stat.needs_render:
-          stat.WriteImage(FLAGS.output_dir)
-    if FLAGS.monthly:
-      for stat in self.monthly_stats.values():
-        if stat.needs_render:
-          stat.WriteImage(FLAGS.output_dir)
+  def WindowsToRender(self):
+    """Return [(granularity, StatsProc)] for the windows due a render.
+
+    A window is due when its data changed, at most once per interval. It's
+    taken as rendered once returned.
+    """
+    now = time.time()
+    rendered = {}
+    due = []
+    for granularity, enabled, windows in (
+        ('hourly', FLAGS.hourly, self.hourly_stats),
+        ('daily', FLAGS.daily, self.daily_stats),
+        ('weekly', FLAGS.weekly, self.weekly_stats),
+        ('monthly', FLAGS.monthly, self.monthly_stats)):
+      if not enabled:
+        continue
+      for stat in windows.values():
+        window = (stat.png_filename, tuple(stat.days))
+        fingerprint, last_render = self.rendered.get(window, (None, 0))
+        if (stat.Fingerprint() != fingerprint and
+            now - last_render >= RENDER_INTERVAL[granularity]):
+          due.append((granularity, stat))
+          fingerprint, last_render = stat.Fingerprint(), now
+        rendered[window] = (fingerprint, last_render)
+    # aged out windows are forgotten
+    self.rendered = rendered
+    return due
+
+  def WantFile(self, full_path):
+    fname = os.path.basename(full_path)
+    if 'large' in fname:
+      return False
+    if self.fname_match and self.fname_match not in fname:
+      return False
+    if FLAGS.hourly and self.WithinLastMins(fname, req_min_diff=65):
+      return True
+    if not (FLAGS.daily or FLAGS.weekly or FLAGS.monthly):
+      return False
+    if self.TooOld(fname):
+      return False
+    # can't deal with changed files at this time, without restarting.
+    return full_path not in self.processed_files
+
+  def AddFile(self, full_path, parsed):
+    fname = os.path.basename(full_path)
+    if FLAGS.hourly and self.WithinLastMins(fname, req_min_diff=65):
+      datestamp = DATE_RE.search(fname).groups()
+      self.hourly_buckets.setdefault(datestamp, []).append((full_path, parsed))
+      self.ProcessStatFile(full_path, parsed, hourly=True)
+    if ((FLAGS.daily or FLAGS.weekly or FLAGS.monthly) and
+        full_path not in self.processed_files and
+        not self.TooOld(os.path.basename(full_path))):
+      self.ProcessStatFile(full_path, parsed, hourly=False)
+      self.processed_files.add(full_path)
+      self.AddDayFile(full_path)
 
-  def ScanHourlyFiles(self):
+  def AddDayFile(self, full_path):
+    datestr = os.path.basename(os.path.dirname(full_path))
+    self.day_files.setdefault(datestr, set()).add(full_path)
+
+  def UpdateHourly(self):
+    """Evict the 5-minute buckets that have aged out of the hourly view."""
+    evicted = False
+    evicted_days = set()
+    for datestamp in sorted(self.hourly_buckets):
+      files = self.hourly_buckets[datestamp]
+      if self.WithinLastMins(os.path.basename(files[0][0]),
+                             req_min_diff=65):
+        break
+      del self.hourly_buckets[datestamp]
+      evicted = True
+      for _, parsed in files:
+        if parsed and parsed[0] in self.hourly_store.buckets:
+          self.hourly_store.Evict(parsed[0])
+          evicted_days.add(parsed[0][0])
+    if not evicted:
+      return
+    # The windows' inputs changed, and some may be empty now.
+    old_stats = self.hourly_stats
     self.hourly_stats = {}
-    for dirpath, _, filenames in os.walk(self.input_dir):
-      for fname in sorted(filenames):
-        if 'large' in fname:
-          continue
-        if self.fname_match and self.fname_match not in fname:
-          continue
-        full_path = os.path.join(dirpath, fname)
-        if not self.WithinLastMins(fname, req_min_diff=65):
+    for files in self.hourly_buckets.itervalues():
+      for full_path, parsed in files:
+        self.ProcessStatFile(full_path, parsed, hourly=True, add_rows=False)
+        if not parsed or parsed[0][0] not in evicted_days:
           continue
-        self.ProcessStatFile(full_path)
+        for key, _, _, distinct in parsed[1]:
+          if distinct:
+            self.hourly_store.AddDistinct(parsed[0][0], self.keys.Id(key),
+                                          distinct)
+    # keep the legends steady across the eviction
+    for hourly_key, stat in self.hourly_stats.iteritems():
+      if hourly_key in old_stats:
+        stat.top_rows = old_stats[hourly_key].top_rows
+
+  def CheckpointName(self, checkpoint_dir):
+    return '%s/graph_analysis%s.checkpoint' % (checkpoint_dir,
+                                               self.fname_suffix)
+
+  def SaveCheckpoint(self, checkpoint_dir):
+    """Save the long windows' data, and which files went into it."""
+    t1s = time.time()
+    sections = self.store.Sections()
+    sections.append(('files', PackLines(sorted(self.processed_files))))
+    WriteCheckpoint(self.CheckpointName(checkpoint_dir), sections)
+    print 'Saved checkpoint (%s): %d files, %.1f sec' % (
+        self.subtitle, len(self.processed_files), time.time()-t1s)
+
+  def LoadCheckpoint(self, checkpoint_dir):
+    """Start from a checkpoint; only files it hasn't seen get read."""
+    t1s = time.time()
+    sections = ReadCheckpoint(self.CheckpointName(checkpoint_dir))
+    if not sections:
+      return
+    self.store.Restore(sections)
+    self.processed_files = set(UnpackLines(sections['files']))
+    for full_path in self.processed_files:
+      self.AddDayFile(full_path)
+    # rollups are written before the checkpoint, so they match it;
+    # LoadRollups forgets the days that turn out to have none
+    for day, files in self.day_files.iteritems():
+      self.rolled_up[day] = len(files)
+    for day in self.store.day_totals:
+      self.MakeWindows(day, hourly=False)
+    print 'Loaded checkpoint (%s): %d files, %.1f sec' % (
+        self.subtitle, len(self.processed_files), time.time()-t1s)
+
+  def RollupName(self, rollup_dir, day):
+    return '%s/%s%s.rollup' % (rollup_dir, day, self.fname_suffix)
+
+  def LoadRollups(self, rollup_dir):
+    """Read in the rollups of days that aren't in the store yet."""
+    t1s = time.time()
+    suffix = self.fname_suffix + '.rollup'
+    loaded = 0
+    fnames = set(os.listdir(rollup_dir))
+    for day in list(self.rolled_up):
+      if os.path.basename(self.RollupName(rollup_dir, day)) not in fnames:
+        del self.rolled_up[day]
+    for fname in sorted(fnames):
+      day = fname[:-len(suffix)]
+      if (not fname.endswith(suffix) or len(day) != 8 or not day.isdigit() or
+          day in self.store.day_totals or
+          self.TimeTooOld(datetime.datetime(*DayKey(day) + (23, 55)))):
+        continue
+      sections = ReadCheckpoint(os.path.join(rollup_dir, fname))
+      if not sections:
+        continue
+      day_store = SeriesStore(self.keys)
+      day_store.Restore(sections)
+      self.store.AddStore(day_store)
+      files = UnpackLines(sections['files'])
+      self.processed_files.update(files)
+      for full_path in files:
+        self.AddDayFile(full_path)
+      self.rolled_up[day] = len(files)
+      self.MakeWindows(day, hourly=False)
+      loaded += 1
+    print 'Loaded rollups (%s): %d days, %.1f sec' % (
+        self.subtitle, loaded, time.time()-t1s)
+
+  def WriteRollups(self, rollup_dir):
+    """Roll up each finished day that's changed since it was last rolled up.
+
+    A day is finished once it's over; a file arriving late for it gets it
+    rolled up again.
+    """
+    today = datetime.date.today().strftime('%Y%m%d')
+    for day, files in sorted(self.day_files.iteritems()):
+      if (day >= today or day not in self.store.day_totals or
+          self.rolled_up.get(day) == len(files)):
+        continue
+      day_store = SeriesStore(self.keys)
+      day_store.AddStore(self.store, [day])
+      sections = day_store.Sections()
+      sections.append(('files', PackLines(sorted(files))))
+      WriteCheckpoint(self.RollupName(rollup_dir, day), sections)
+      self.rolled_up[day] = len(files)
+      print 'Wrote rollup (%s): %s, %d files' % (self.subtitle, day,
+                                                 len(files))
 
   def WithinLastMins(self, fname, req_min_diff=60):
     date_match = DATE_RE.search(fname)
@@ -481,43 +1812,6 @@ class ProcessStats(object):
       return True
     return False
 
-  def ScanNewFiles(self, single_dir=False):
-    found_files = False
-    for dirpath, _, filenames in os.walk(self.input_dir):
-      last_dirname_printed = ''
-      file_count = 0
-      fname = ''
-      for fname in sorted(filenames):
-        if 'large' in fname:
-          continue
-        if self.fname_match and self.fname_match not in fname:
-          continue
-        full_path = os.path.join(dirpath, fname)
-        if self.TooOld(fname):
-          continue
-        statf = os.stat(full_path)
-        if full_path in self.processed_files:
-          # can't deal with changed files at this time, without restarting.
-          # we've already seen it and it hasn't changed.
-          continue
-        if statf.st_size == 0 or statf.st_mtime+30 > time.time():
-          # too new, or 0 bytes
-          continue
-        file_count += 1
-        if last_dirname_printed != dirpath or (file_count%250 == 0):
-          print 'Processing stats in dir: %s (%d files, last %s)' % (
-              dirpath, file_count, fname)
-        last_dirname_printed = dirpath
-        self.ProcessStatFile(full_path)
-        self.processed_files[full_path] = statf.st_mtime
-        found_files = True
-      if single_dir and found_files:
-        # abort here, this allows cleanup in the daily files
-        break
-      if last_dirname_printed != '' and (file_count%250 != 0):
-        print 'Processing stats in dir: %s (%d files, last %s)' % (
-            dirpath, file_count, fname)
-
   def AgeOutStats(self):
     dt = datetime.datetime.now()
     # convert to a date
@@ -540,17 +1834,54 @@ class ProcessStats(object):
         key_dt = datetime.date(*key_dt_tuple)
         if (dt-key_dt).days > 32:
           del self.monthly_stats[key_dt_tuple]
+    # keep only the days some window still shows
+    first_day = min([min(stat.days) for stats in
+                     (self.daily_stats, self.weekly_stats, self.monthly_stats)
+                     for stat in stats.itervalues()] or ['99999999'])
+    self.store.Truncate(first_day)
+    for day_dict in (self.day_files, self.rolled_up):
+      for day in [day for day in day_dict if day < first_day]:
+        del day_dict[day]
     print 'After ageout - daily/weekly/monthly: %d/%d/%d' % (
         len(self.daily_stats), len(self.weekly_stats), len(self.monthly_stats))
 
-  def ProcessStatFile(self, fname):
+  def ProcessStatFile(self, fname, parsed, hourly, add_rows=True):
+    """Add a parsed file to the hourly window, or to the longer ones.
+
+    Without add_rows, only the windows learn of the file; its rows are
+    taken to be in the store already.
+    """
     # get the directory, which has the yyyymmdd name
     datestr = os.path.basename(os.path.dirname(fname))
     if not datestr.startswith('2') or len(datestr) != 8:
       print 'Invalid dir: %s' % datestr
       return
-    dateon = datetime.date(int(datestr[:4]), int(datestr[4:6]),
-                           int(datestr[6:8]))
+    hourly_key, daily_key, weekly_key, monthly_key = self.MakeWindows(
+        datestr, hourly)
+
+    if not parsed:
+      return
+    datestamp, rows = parsed
+    if hourly:
+      if add_rows:
+        self.hourly_store.Add(datestamp, rows)
+      self.hourly_stats[hourly_key].AddInput(fname)
+      return
+    if add_rows:
+      self.store.Add(datestamp, rows)
+    if FLAGS.daily:
+      self.daily_stats[daily_key].AddInput(fname)
+    if FLAGS.weekly:
+      self.weekly_stats[weekly_key].AddInput(fname)
+    if FLAGS.monthly:
+      self.monthly_stats[monthly_key].AddInput(fname)
+
+  def MakeWindows(self, datestr, hourly):
+    """Create any missing windows for the day datestr (yyyymmdd).
+
+    Returns the hourly, daily, weekly and monthly window keys.
+    """
+    dateon = datetime.date(*DayKey(datestr))
     hourly_key = (dateon.year, dateon.month, dateon.day)
     daily_key = (dateon.year, dateon.month, dateon.day)
     monthly_key = (dateon.year, dateon.month, 1)
@@ -560,26 +1891,30 @@ class ProcessStats(object):
       weekly_start -= datetime.timedelta(1)
     weekly_key = (weekly_start.year, weekly_start.month, weekly_start.day)
 
-    if FLAGS.hourly and hourly_key not in self.hourly_stats:
+    if hourly and hourly_key not in self.hourly_stats:
       title = 'OneNet (%s): 1-hour view - %d/%d/%d' % (
           self.subtitle, daily_key[1], daily_key[2], daily_key[0])
       filename = 'onenet-99999999-hourly%s' % (self.fname_suffix)
-      self.hourly_stats[hourly_key] = StatsProc(title, filename)
-    if FLAGS.daily and daily_key not in self.daily_stats:
+      self.hourly_stats[hourly_key] = StatsProc(
+          title, filename, self.hourly_store, [datestr])
+    if not hourly and FLAGS.daily and daily_key not in self.daily_stats:
       title = 'OneNet (%s): %d/%d/%d' % (
           self.subtitle, daily_key[1], daily_key[2], daily_key[0])
       filename = 'onenet-%04d%02d%02d-daily%s' % (
           daily_key[0], daily_key[1], daily_key[2], self.fname_suffix)
-      self.daily_stats[daily_key] = StatsProc(title, filename)
-    if FLAGS.weekly and weekly_key not in self.weekly_stats:
+      self.daily_stats[daily_key] = StatsProc(
+          title, filename, self.store, [datestr])
+    if not hourly and FLAGS.weekly and weekly_key not in self.weekly_stats:
       week_end = datetime.date(*weekly_key) + datetime.timedelta(6)
       title = 'OneNet (%s): %d/%d/%d to %d/%d/%d' % (
           self.subtitle, weekly_key[1], weekly_key[2], weekly_key[0],
           week_end.month, week_end.day, week_end.year)
       filename = 'onenet-%04d%02d%02d-weekly%s' % (
           weekly_key[0], weekly_key[1], weekly_key[2], self.fname_suffix)
-      self.weekly_stats[weekly_key] = StatsProc(title, filename)
-    if FLAGS.monthly and monthly_key not in self.monthly_stats:
+      self.weekly_stats[weekly_key] = StatsProc(
+          title, filename, self.store, DayStrings(weekly_start, 7))
+    if (not hourly and FLAGS.monthly and
+        monthly_key not in self.monthly_stats):
       month_end = datetime.date(*monthly_key) + datetime.timedelta(32)
       month_end = (datetime.date(month_end.year, month_end.month, 1) -
                    datetime.timedelta(1))
@@ -588,20 +1923,27 @@ class ProcessStats(object):
           month_end.month, month_end.day, month_end.year)
       filename = 'onenet-%04d%02d01-monthly%s' % (
           monthly_key[0], monthly_key[1], self.fname_suffix)
-      self.monthly_stats[monthly_key] = StatsProc(title, filename)
+      self.monthly_stats[monthly_key] = StatsProc(
+          title, filename, self.store,
+          DayStrings(datetime.date(*monthly_key), month_end.day))
+    return hourly_key, daily_key, weekly_key, monthly_key
 
-    if FLAGS.hourly:
-      self.hourly_stats[hourly_key].AddStats(fname)
-    if FLAGS.daily:
-      self.daily_stats[daily_key].AddStats(fname)
-    if FLAGS.weekly:
-      self.weekly_stats[weekly_key].AddStats(fname)
-    if FLAGS.monthly:
-      self.monthly_stats[monthly_key].AddStats(fname)
 
+def DayKey(datestr):
+  """(year, month, day) for a yyyymmdd string."""
+  return int(datestr[:4]), int(datestr[4:6]), int(datestr[6:8])
 
-try:
-  print 'running'
-  main(sys.argv)
-except KeyboardInterrupt:
-  pass
+
+def DayStrings(start, count):
+  """yyyymmdd for count days from the date start."""
+  return [(start + datetime.timedelta(day)).strftime('%Y%m%d')
+          for day in xrange(count)]
+
+
+# importable, for graph_analysis_test.py
+if __name__ == '__main__':
+  try:
+    print 'running'
+    main(sys.argv)
+  except KeyboardInterrupt:
+    pass
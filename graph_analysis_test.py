@@ -0,0 +1,294 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for graph_analysis."""
+
+import bisect
+import collections
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+import graph_analysis
+
+
+class SortedList(object):
+  """The parts of blist.sortedlist the old GetTopRows used."""
+
+  def __init__(self, items, key):
+    self.key = key
+    self.items = sorted(items, key=key)
+    self.keys = [key(x) for x in self.items]
+
+  def __len__(self):
+    return len(self.items)
+
+  def __iter__(self):
+    return iter(self.items)
+
+  def __getitem__(self, index):
+    return self.items[index]
+
+  def pop(self):
+    self.keys.pop()
+    return self.items.pop()
+
+  def add(self, item):
+    index = bisect.bisect_right(self.keys, self.key(item))
+    self.keys.insert(index, self.key(item))
+    self.items.insert(index, item)
+
+  def discard(self, item):
+    if item in self.items:
+      index = self.items.index(item)
+      del self.keys[index]
+      del self.items[index]
+
+
+def OldGetTopRows(proc, stats_group_orig, max_elements, max_size_pct):
+  """GetTopRows as it was with blist, scanning the rows for each merge."""
+  stats_group_size = dict(stats_group_orig)
+  stats_group = SortedList(
+      stats_group_orig, key=lambda x: -stats_group_size[x])
+  max_size = sum(stats_group_size.values()) * max_size_pct
+  stats_parents = collections.defaultdict(set)
+  while len(stats_group) > max_elements:
+    combine = stats_group.pop()
+    combine_parent = (':'.join(combine.split(':')[:-1])).rstrip(':')
+    best_level = None
+    best_common_name = ''
+    best_parta = None
+    if combine_parent in stats_group_size:
+      best_common_name = combine_parent
+    else:
+      for index in xrange(len(stats_group)-1, -1, -1):
+        parta = stats_group[index]
+        level_match, common_name = proc.GetCommonName(parta, combine)
+        if common_name != parta and stats_group_size[parta] > max_size:
+          break
+        if (best_level is None or level_match > best_level or
+            common_name == parta):
+          if (best_common_name and
+              best_common_name == best_parta and best_level == level_match):
+            continue
+          if level_match <= best_level and common_name != parta:
+            continue
+          best_level = level_match
+          best_common_name = common_name
+          best_parta = parta
+      if not best_common_name:
+        best_parta = None
+      if best_common_name not in stats_group_size:
+        stats_group_size[best_common_name] = 0
+        if best_common_name:
+          stats_group.add(best_common_name)
+      elif best_common_name == combine:
+        stats_group.add(best_common_name)
+    if combine != best_common_name:
+      stats_group.discard(best_common_name)
+      stats_group_size[best_common_name] += stats_group_size[combine]
+      if best_common_name:
+        stats_group.add(best_common_name)
+      stats_parents[best_common_name].add(combine)
+      del stats_group_size[combine]
+    if best_common_name != best_parta and best_parta:
+      stats_group.discard(best_common_name)
+      stats_group_size[best_common_name] += stats_group_size[best_parta]
+      if best_common_name:
+        stats_group.add(best_common_name)
+      stats_parents[best_common_name].add(best_parta)
+      stats_group.discard(best_parta)
+      del stats_group_size[best_parta]
+  stats_group = list(stats_group)
+  if '' in stats_group_size:
+    stats_group.append('')
+  return [(sg, proc.GetExpandedGroup(sg, stats_parents, stats_group_orig))
+          for sg in stats_group]
+
+
+def Totals(count, seed):
+  """count made up keys, like file_analysis writes, with their byte counts."""
+  rand = random.Random(seed)
+  groups = [('UDP', 'flood'), ('UDP', 'DNS'), ('UDP', 'SIP'), ('UDP', ''),
+            ('TCP', 'ACK'), ('TCP', 'SYN'), ('TCP', 'Close'),
+            ('ICMP', 'type-8'), ('ICMP', 'type-3'), ('GRE', '')]
+  specials = ['', '0xffff', '0x101-offset', 'DNSReq', 'REGISTER'] + [
+      '0x%04x' % rand.randint(0, 65535) for _ in xrange(100)]
+  totals = {}
+  while len(totals) < count:
+    proto, group = rand.choice(groups)
+    special = rand.choice(specials) if group in ('flood', 'DNS', 'SIP') else ''
+    if rand.random() < 0.02:
+      key = ':'.join([proto, group, special]).rstrip(':')
+    else:
+      key = '%s:%s:%s:1.%d.%d.%d|%d' % (
+          proto, group, special, rand.randint(0, 3), rand.randint(0, 3),
+          rand.randint(1, 254), rand.choice([53, 80, 5060, 2727]))
+    totals[key] = (totals.get(key, 0) +
+                   int(rand.paretovariate(1.1) * rand.choice([1, 100])))
+  return totals
+
+
+class GetTopRowsTest(unittest.TestCase):
+
+  def setUp(self):
+    store = graph_analysis.SeriesStore(graph_analysis.KeyRegistry())
+    self.proc = graph_analysis.StatsProc('title', 'png', store, [])
+
+  def assertSameRows(self, totals, max_elements, max_size_pct):
+    self.assertEqual(
+        OldGetTopRows(self.proc, totals, max_elements, max_size_pct),
+        self.proc.GetTopRows(totals, max_elements, max_size_pct))
+
+  def testSameAsOld(self):
+    for seed in xrange(1, 6):
+      for count in (10, 100, 1500):
+        self.assertSameRows(Totals(count, seed), graph_analysis.TOPN,
+                            graph_analysis.KEEP_PCT)
+
+  def testSameAsOldOtherLimits(self):
+    for seed in xrange(1, 4):
+      totals = Totals(800, seed)
+      for max_elements, max_size_pct in ((5, 0.04), (33, 0.001), (10, 0.5)):
+        self.assertSameRows(totals, max_elements, max_size_pct)
+
+  def testTies(self):
+    totals = dict(('UDP:flood:0x%04x:1.1.1.%d|53' % (x % 7, x), 5)
+                  for x in xrange(200))
+    totals.update({'UDP': 5, 'TCP:ACK::1.1.1.1|80': 5, '': 5})
+    self.assertSameRows(totals, 10, 0.04)
+
+  def testFewKeys(self):
+    totals = {'UDP:flood::1.1.1.1|53': 10, 'TCP:ACK::1.1.1.1|80': 20}
+    self.assertEqual(
+        [('TCP:ACK::1.1.1.1|80', set(['TCP:ACK::1.1.1.1|80'])),
+         ('UDP:flood::1.1.1.1|53', set(['UDP:flood::1.1.1.1|53']))],
+        self.proc.GetTopRows(totals, 33, 0.04))
+
+
+class FakeRenderer(object):
+
+  def __init__(self):
+    self.plots = []
+
+  def Plot(self, png_filename, name, title, ylabel, labels, colors,
+           datestamps, rates, stacked):
+    self.plots.append((png_filename, labels, rates))
+
+
+class CachedTopRowsTest(unittest.TestCase):
+
+  def setUp(self):
+    graph_analysis.FLAGS = graph_analysis.AP_FLAGS.parse_args(['input'])
+
+  def testEvictAndCompact(self):
+    keys = graph_analysis.KeyRegistry()
+    store = graph_analysis.SeriesStore(keys)
+    # the flood keys share the TCP:SYN row with a few steady ones, so the
+    # rows still fit once the flood is gone
+    steady = [('UDP:DNS::1.1.1.%d|53' % x, 1, 1000, None)
+              for x in xrange(20)]
+    steady += [('TCP:SYN::1.1.1.%d|80' % x, 1, 1, None) for x in xrange(5)]
+    flood = [('TCP:SYN::1.0.%d.%d|80' % (x / 250, x % 250), 1, 1, None)
+             for x in xrange(2000)]
+    store.Add(('20200101', '0000'), steady + flood)
+    store.Add(('20200101', '0005'), steady)
+    proc = graph_analysis.StatsProc('title', 'png', store, ['20200101'])
+    renderer = FakeRenderer()
+    proc.WriteImage('output', renderer)
+    # the hourly view's oldest bucket ages out, taking the flood keys with it
+    store.Evict(('20200101', '0000'))
+    keys.Compact([store])
+    self.assertFalse(any(key in keys.ids for key, _, _, _ in flood))
+    proc.WriteImage('output', renderer)
+    total_pkts, _ = store.Totals(['20200101'])
+    for _, row_keys in proc.CachedTopRows('packets', total_pkts):
+      self.assertTrue(row_keys <= set(total_pkts))
+    # bps-log: the steady keys' bits over the one 5 minute bucket left
+    png_filename, _, rates = renderer.plots[-2]
+    self.assertEqual('output/png-bps-log.png', png_filename)
+    self.assertAlmostEqual(8 * (20 * 1000 + 5) / 300.0, sum(rates[0]))
+
+
+class RollupsTest(unittest.TestCase):
+
+  def setUp(self):
+    graph_analysis.FLAGS = graph_analysis.AP_FLAGS.parse_args(
+        ['--daily', '--scan_all_dates', 'input'])
+    self.tmp_dir = tempfile.mkdtemp()
+    self.checkpoint_dir = os.path.join(self.tmp_dir, 'checkpoint')
+    self.rollup_dir = os.path.join(self.tmp_dir, 'rollup')
+    os.mkdir(self.checkpoint_dir)
+    os.mkdir(self.rollup_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def NewStats(self):
+    return graph_analysis.ProcessStats('input', '',
+                                       graph_analysis.KeyRegistry())
+
+  def testRestartFromCheckpoint(self):
+    stats = self.NewStats()
+    for day in ('20200101', '20200102'):
+      fname = 'input/%s/onenet-%s-0000.stats' % (day, day)
+      stats.store.Add((day, '0000'), [('UDP', 1, 100, None)])
+      stats.processed_files.add(fname)
+      stats.AddDayFile(fname)
+    stats.WriteRollups(self.rollup_dir)
+    # as if the checkpoint was taken before the second day was over
+    os.remove(stats.RollupName(self.rollup_dir, '20200102'))
+    stats.SaveCheckpoint(self.checkpoint_dir)
+    restarted = self.NewStats()
+    restarted.LoadCheckpoint(self.checkpoint_dir)
+    restarted.LoadRollups(self.rollup_dir)
+    self.assertEqual({'20200101': 1}, restarted.rolled_up)
+    restarted.WriteRollups(self.rollup_dir)
+    self.assertEqual({'20200101': 1, '20200102': 1}, restarted.rolled_up)
+    self.assertTrue(os.path.exists(
+        restarted.RollupName(self.rollup_dir, '20200102')))
+
+
+class StatsWatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.day_dir = os.path.join(self.tmp_dir, '20200101')
+    os.mkdir(self.day_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def testEmptyFileRetried(self):
+    watcher = graph_analysis.StatsWatcher(self.tmp_dir)
+    fname = os.path.join(self.day_dir, 'onenet-20200101-0000.stats')
+    open(fname, 'w').close()
+    # as for an IN_CLOSE_WRITE event
+    watcher.AddFile(fname, finished=True)
+    self.assertEqual([], list(watcher.new_files))
+    fh = open(fname, 'w')
+    fh.write('UDP\t1\t100\n')
+    fh.close()
+    settled = time.time() - graph_analysis.STATS_SETTLE_SECS
+    os.utime(fname, (settled, settled))
+    watcher.CheckUnfinished()
+    self.assertEqual([fname], list(watcher.new_files))
+
+
+if __name__ == '__main__':
+  unittest.main()
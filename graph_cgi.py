@@ -182,7 +182,9 @@ def PrintImageLink(img):
 
 def main():
   form = cgi.FieldStorage()
-  files = os.listdir(GRAPHS)
+  # graph_analysis.py renders to dotfiles and renames them into place
+  files = [fname for fname in os.listdir(GRAPHS)
+           if not fname.startswith('.')]
   fh = open('/var/www/graphs/graph.head.html')
   print fh.read()
   fh.close()
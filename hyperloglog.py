@@ -0,0 +1,129 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""HyperLogLog distinct-value counting, shared by the analysis scripts."""
+
+import base64
+import math
+import struct
+import zlib
+
+# 2**PRECISION registers; the standard error is about 1.04/sqrt(registers),
+# 3.3% here. Sketches only merge with others of the same precision.
+PRECISION = 10
+REGISTERS = 1 << PRECISION
+RANK_BITS = 64 - PRECISION
+ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+# Registers are kept in a dict until this many are set.
+DENSE_AT = REGISTERS / 8
+MASK64 = (1 << 64) - 1
+
+
+def Mix64(val):
+  """Spread the bits of a small int over 64 bits (splitmix64)."""
+  val = (val + 0x9e3779b97f4a7c15) & MASK64
+  val = ((val ^ (val >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+  val = ((val ^ (val >> 27)) * 0x94d049bb133111eb) & MASK64
+  return val ^ (val >> 31)
+
+
+class HyperLogLog(object):
+  """Estimate the number of distinct ints added, in at most 1kB.
+
+  Sketches merge by taking the larger of each register, so the estimate for
+  a union of inputs can be had without seeing the values again.
+  """
+
+  def __init__(self):
+    # register index -> rank while sparse, then a bytearray
+    self.registers = {}
+
+  def Add(self, val):
+    hashed = Mix64(val)
+    index = hashed & (REGISTERS - 1)
+    rank = RANK_BITS - (hashed >> PRECISION).bit_length() + 1
+    registers = self.registers
+    if isinstance(registers, dict):
+      if rank > registers.get(index, 0):
+        registers[index] = rank
+        if len(registers) > DENSE_AT:
+          self.Densify()
+    elif rank > registers[index]:
+      registers[index] = rank
+
+  def Densify(self):
+    registers = bytearray(REGISTERS)
+    for index, rank in self.registers.iteritems():
+      registers[index] = rank
+    self.registers = registers
+
+  def Items(self):
+    """Yield (index, rank) for each register that's set."""
+    if isinstance(self.registers, dict):
+      return self.registers.iteritems()
+    return ((index, rank) for index, rank in enumerate(self.registers)
+            if rank)
+
+  def Merge(self, other):
+    registers = self.registers
+    if isinstance(registers, dict) and not isinstance(other.registers, dict):
+      self.Densify()
+      registers = self.registers
+    for index, rank in other.Items():
+      if isinstance(registers, dict):
+        if rank > registers.get(index, 0):
+          registers[index] = rank
+      elif rank > registers[index]:
+        registers[index] = rank
+    if isinstance(registers, dict) and len(registers) > DENSE_AT:
+      self.Densify()
+
+  def Estimate(self):
+    ranks = [rank for _, rank in self.Items()]
+    zeros = REGISTERS - len(ranks)
+    estimate = ALPHA * REGISTERS * REGISTERS / (
+        zeros + sum(2.0 ** -rank for rank in ranks))
+    if estimate <= 2.5 * REGISTERS and zeros:
+      # small range correction: linear counting
+      estimate = REGISTERS * math.log(float(REGISTERS) / zeros)
+    return int(round(estimate))
+
+  def Encode(self):
+    """Return the registers as a compact string with no tabs or colons."""
+    items = sorted(self.Items())
+    if len(items) >= REGISTERS / 2:
+      # every register, one byte each
+      registers = bytearray(REGISTERS)
+      for index, rank in items:
+        registers[index] = rank
+      packed = str(registers)
+    else:
+      # (index, rank) pairs, in two bytes each
+      packed = struct.pack(
+          '!%dH' % len(items), *[index << 6 | rank for index, rank in items])
+    return base64.b64encode(zlib.compress(packed))
+
+
+def Decode(text):
+  """Return the HyperLogLog that Encode turned into text."""
+  hll = HyperLogLog()
+  packed = zlib.decompress(base64.b64decode(text))
+  if len(packed) == REGISTERS:
+    hll.registers = bytearray(packed)
+    return hll
+  for entry in struct.unpack('!%dH' % (len(packed) / 2), packed):
+    hll.registers[entry >> 6] = entry & 0x3f
+  if len(hll.registers) > DENSE_AT:
+    hll.Densify()
+  return hll
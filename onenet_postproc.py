@@ -194,9 +194,10 @@ class DirHandler(object):
     if ('sample' in full_path and
         os.path.basename(full_path).startswith('1') and
         full_path.endswith('.gz')):
-      # post-process files that match 1*sample.gz, remove the .gz part
+      # post-process files that match 1*sample.gz. file_analysis reads the
+      # .gz itself, so this doesn't need the uncompressed copy.
       self.files_processing[full_path] = RunProc(
-          ['/usr/local/bin/file_analysis.py', os.readlink(full_path)[:-3]],
+          ['/usr/local/bin/file_analysis.py', os.readlink(full_path)],
           None, None)
     try:
       os.unlink(full_path)
@@ -0,0 +1,91 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Binary .stats files, shared by the analysis scripts.
+
+A file is a header, the class names as a newline-separated string table,
+the packet and byte counts as little-endian int64 columns, then for each
+distinct-count field its name and one encoded HyperLogLog per class, also
+newline-separated. Counts are already scaled up by the sample rate, as in
+the tab-separated files; the rate is kept in the header for reference.
+"""
+
+import array
+import struct
+import sys
+
+MAGIC = 'OSB1'
+# magic, capture start (yyyymmddhhmm), sample rate, classes, distinct
+# fields, string table length
+HEADER = struct.Struct('<4s12sdIII')
+
+
+def Write(fh, rows, sample_rate, capture_time, fields):
+  """Write rows of (name, pkts, bytes, {field: HyperLogLog}) to fh."""
+  names = '\n'.join(row[0] for row in rows)
+  fh.write(HEADER.pack(MAGIC, capture_time, sample_rate, len(rows),
+                       len(fields), len(names)))
+  fh.write(names)
+  fh.write('\0' * (-fh.tell() % 8))
+  fh.write(struct.pack('<%dq' % len(rows), *[row[1] for row in rows]))
+  fh.write(struct.pack('<%dq' % len(rows), *[row[2] for row in rows]))
+  for field in fields:
+    fh.write('\n'.join([field] + [row[3][field].Encode() for row in rows]))
+    fh.write('\n')
+
+
+def Read(data):
+  """Return (capture time, sample rate, names, pkts, bytes, distinct).
+
+  pkts and bytes are arrays; distinct is [(field, the classes' encoded
+  sketches)] in the order the file lists the fields, and hyperloglog.Decode
+  turns the sketches back into HyperLogLogs. Raises ValueError if data
+  isn't a binary .stats file.
+  """
+  if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+    raise ValueError('not a binary stats file')
+  (unused_magic, capture_time, sample_rate, num_rows, num_fields,
+   names_len) = HEADER.unpack_from(data)
+  offset = HEADER.size
+  names = data[offset:offset+names_len].split('\n') if num_rows else []
+  if len(names) != num_rows:
+    raise ValueError('truncated binary stats file')
+  offset += names_len
+  offset += -offset % 8
+  counts = []
+  for unused_column in xrange(2):
+    end = offset + 8 * num_rows
+    if end > len(data):
+      raise ValueError('truncated binary stats file')
+    counts.append(Int64Column(data[offset:end]))
+    offset = end
+  lines = data[offset:].split('\n')
+  distinct = []
+  for index in xrange(num_fields):
+    start = index * (num_rows + 1)
+    if start + num_rows >= len(lines):
+      raise ValueError('truncated binary stats file')
+    distinct.append((lines[start], lines[start+1:start+1+num_rows]))
+  return capture_time, sample_rate, names, counts[0], counts[1], distinct
+
+
+def Int64Column(data):
+  """Little-endian int64s from data; an array('l') where longs are 64 bits."""
+  if array.array('l').itemsize != 8:
+    return list(struct.unpack('<%dq' % (len(data) / 8), data))
+  column = array.array('l')
+  column.fromstring(data)
+  if sys.byteorder != 'little':
+    column.byteswap()
+  return column